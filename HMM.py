@@ -10,15 +10,27 @@ Author(s):    Andrew Kang, Garret Sullivan
 Organization: California Institute of Technology
 """
 
+import bisect
+import itertools
+import multiprocessing
 import numpy as np
+import os
+import pickle
 import random
+import struct
+import time
+import tracemalloc
+import zipfile
+
+import HMM_kernels
+from syllables import SyllableIndex
 
 class HiddenMarkovModel:
     '''
     Class implementation of Hidden Markov Models.
     '''
 
-    def __init__(self, A, O):
+    def __init__(self, A, O, dtype=np.float64):
         '''
         Initializes an HMM. Assumes the following:
             - States and observations are integers starting from 0. 
@@ -37,26 +49,155 @@ class HiddenMarkovModel:
                         The (i, j)^th element is the probability of
                         emitting observation j given state i.
 
+            dtype:      Floating point type the matrices are stored in,
+                        np.float64 or np.float32. float32 halves the memory
+                        of the model, most of which is O.
+
         Parameters:
             L:          Number of states.
 
             D:          Number of observations.
             
-            A:          The transition matrix.
+            A:          The transition matrix, as a read-only C-contiguous
+                        array. Assign a new matrix to change it, so that
+                        the tables derived from it are rebuilt.
             
-            O:          The observation matrix.
+            O:          The observation matrix, read-only like A.
+            
+            dtype:      The floating point type of A, O and A_start.
             
             A_start:    Starting transition probabilities. The i^th element
                         is the probability of transitioning from the start
                         state to state i. For simplicity, we assume that
                         this distribution is uniform.
+
+            vocabulary: Optional list of the word for each observation,
+                        stored along with the model in the binary format.
+        '''
+
+        # Arrays and tables derived from A and O, built on demand.
+        self._cache = {}
+
+        self.dtype = np.dtype(dtype)
+        self.A = A
+        self.O = O
+        self.L, self.D = self.O.shape
+        self.A_start = np.full(self.L, 1. / self.L, dtype=self.dtype)
+        self.vocabulary = None
+
+
+    @property
+    def A(self):
+        ''' The transition matrix. '''
+
+        return self._A
+
+
+    @A.setter
+    def A(self, A):
+        self._A = self._parameter(A)
+
+
+    @property
+    def O(self):
+        ''' The observation matrix. '''
+
+        return self._O
+
+
+    @O.setter
+    def O(self, O):
+        self._O = self._parameter(O)
+
+
+    def _parameter(self, matrix):
+        '''
+        Converts a new A or O to a read-only contiguous array of the HMM's
+        dtype, and drops everything cached from the old one. Being read-only,
+        it cannot be edited in place behind the caches' back.
         '''
 
-        self.L = len(A)
-        self.D = len(O[0])
+        matrix = np.ascontiguousarray(matrix, dtype=self.dtype).view()
+        matrix.flags.writeable = False
+        self._invalidate()
+
+        return matrix
+
+
+    def _arrays(self):
+        ''' Returns A, O and A_start. '''
+
+        return self.A, self.O, self.A_start
+
+
+    def _invalidate(self):
+        ''' Drops everything cached from the current A and O. '''
+
+        self._cache.clear()
+
+
+    def _set_parameters(self, A, O):
+        ''' Replaces A and O, converting them to the HMM's dtype. '''
+
         self.A = A
         self.O = O
-        self.A_start = [1. / self.L for _ in range(self.L)]
+
+
+    def scaled_forward(self, x):
+        '''
+        Runs the scaled forward algorithm, doing one matrix-vector product
+        per timestep.
+
+        Arguments:
+            x:          Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+        Returns:
+            alphas:     Array of shape (M, L). Row t is the normalized alpha
+                        vector after observing x^1:(t+1), i.e.
+                        P(y^(t+1) = j | x^1:(t+1)).
+
+            scales:     Array of length M. The t^th element is the
+                        normalization constant of row t, so that the sum of
+                        log(scales) is log P(x).
+        '''
+
+        A, O, A_start = self._arrays()
+
+        # The kernels assume at least one timestep.
+        if len(x) == 0:
+            return np.zeros((0, self.L)), np.zeros(0)
+
+        # Only gather the columns of O for the observed symbols.
+        emissions = np.ascontiguousarray(O[:, x].T)
+
+        return HMM_kernels.forward(A, emissions, A_start)
+
+
+    def scaled_backward(self, x, scales):
+        '''
+        Runs the scaled backward algorithm using the scaling factors from
+        scaled_forward, so that alphas * betas gives P(y^t = j | x) directly.
+
+        Arguments:
+            x:          Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+            scales:     The scaling factors returned by scaled_forward(x).
+
+        Returns:
+            betas:      Array of shape (M, L). Row t is beta_j(t + 1) divided
+                        by the product of scales[t + 1:].
+        '''
+
+        A, O, _ = self._arrays()
+
+        if len(x) == 0:
+            return np.zeros((0, self.L))
+
+        emissions = np.ascontiguousarray(O[:, x].T)
+
+        return HMM_kernels.backward(A, emissions, scales, np.ones(self.L))
 
 
     def forward(self, x, normalize=False):
@@ -73,7 +214,7 @@ class HiddenMarkovModel:
                         unsupervised learning.
 
         Returns:
-            alphas:     Vector of alphas.
+            alphas:     Array of alphas with shape (M + 1, L).
 
                         The (i, j)^th element of alphas is alpha_j(i),
                         i.e. the probability of observing prefix x^1:i
@@ -85,34 +226,18 @@ class HiddenMarkovModel:
         '''
 
         M = len(x)      # Length of sequence.
-        alphas = [[0. for _ in range(self.L)] for _ in range(M + 1)]
-
-        # Note that alpha_j(0) is already correct for all j's.
-        # Calculate alpha_j(1) for all j's.
-        for curr in range(self.L):
-            alphas[1][curr] = self.A_start[curr] * self.O[curr][x[0]]
-
-        # Calculate alphas throughout sequence.
-        for t in range(1, M):
-            # Iterate over all possible current states.
-            for curr in range(self.L):
-                prob = 0
-
-                # Iterate over all possible previous states to accumulate
-                # the probabilities of all paths from the start state to
-                # the current state.
-                for prev in range(self.L):
-                    prob += alphas[t][prev] \
-                            * self.A[prev][curr] \
-                            * self.O[curr][x[t]]
-
-                # Store the accumulated probability.
-                alphas[t + 1][curr] = prob
-
-            if normalize:
-                norm = sum(alphas[t + 1])
-                for curr in range(self.L):
-                    alphas[t + 1][curr] /= norm
+        alphas = np.zeros((M + 1, self.L))
+
+        scaled, scales = self.scaled_forward(x)
+
+        if normalize:
+            # Rows after the first are normalized; the first row is left as
+            # the joint probabilities, as the recursion never rescales it.
+            alphas[1:] = scaled
+            alphas[1:2] *= scales[:1, None]
+        else:
+            # Undo the scaling to recover the joint probabilities.
+            alphas[1:] = scaled * np.cumprod(scales)[:, None]
 
         return alphas
 
@@ -131,7 +256,7 @@ class HiddenMarkovModel:
                         unsupervised learning.
 
         Returns:
-            betas:      Vector of betas.
+            betas:      Array of betas with shape (M + 1, L).
 
                         The (i, j)^th element of betas is beta_j(i), i.e.
                         the probability of observing prefix x^(i+1):M and
@@ -142,49 +267,35 @@ class HiddenMarkovModel:
                         given that y^M = 0, i.e. the last state is 0.
         '''
 
+        _, O, A_start = self._arrays()
         M = len(x)      # Length of sequence.
-        betas = [[0. for _ in range(self.L)] for _ in range(M + 1)]
-
-        # Initialize initial betas.
-        for curr in range(self.L):
-            betas[-1][curr] = 1
-
-        # Calculate betas throughout sequence.
-        for t in range(-1, -M - 1, -1):
-            # Iterate over all possible current states.
-            for curr in range(self.L):
-                prob = 0
-
-                # Iterate over all possible next states to accumulate
-                # the probabilities of all paths from the end state to
-                # the current state.
-                for nxt in range(self.L):
-                    if t == -M:
-                        prob += betas[t][nxt] \
-                                * self.A_start[nxt] \
-                                * self.O[nxt][x[t]]
-
-                    else:
-                        prob += betas[t][nxt] \
-                                * self.A[curr][nxt] \
-                                * self.O[nxt][x[t]]
-
-                # Store the accumulated probability.
-                betas[t - 1][curr] = prob
-
-            if normalize:
-                norm = sum(betas[t - 1])
-                for curr in range(self.L):
-                    betas[t - 1][curr] /= norm
+        betas = np.ones((M + 1, self.L))
+
+        _, scales = self.scaled_forward(x)
+        scaled = self.scaled_backward(x, scales)
+
+        # Undo the scaling to recover the conditional probabilities.
+        tail = np.append(np.cumprod(scales[:0:-1])[::-1], 1.)
+        betas[1:] = scaled * tail[:, None]
+
+        # The start state can only transition according to A_start.
+        if M > 0:
+            betas[0] = np.sum(A_start * O[:, x[0]] * betas[1])
+
+        if normalize:
+            betas[:-1] /= betas[:-1].sum(axis=1, keepdims=True)
 
         return betas
 
 
-    def unsupervised_learning(self, X, N_iters):
+    def unsupervised_learning(self, X, N_iters, bucket_width=None, n_jobs=1,
+                              tol=None, verbose=True, checkpoint=None,
+                              checkpoint_every=None, checkpoint_seconds=None,
+                              resume_from=None, low_memory=False,
+                              callbacks=None, trace_memory=False):
         '''
         Trains the HMM using the Baum-Welch algorithm on an unlabeled
-        datset X. Note that this method does not return anything, but
-        instead updates the attributes of the HMM object.
+        datset X, updating the attributes of the HMM object.
 
         Arguments:
             X:          A dataset consisting of input sequences in the form
@@ -192,6 +303,72 @@ class HiddenMarkovModel:
                         from 0 to D - 1. In other words, a list of lists.
 
             N_iters:    The number of iterations to train on.
+
+            bucket_width: If given, sequences whose lengths differ by less
+                        than bucket_width are padded into a single batch,
+                        so that each iteration runs one batched
+                        forward/backward pass per bucket instead of one
+                        per sequence. A width of 1 groups equal lengths
+                        only and needs no padding.
+
+            n_jobs:     Number of worker processes for the E-step. X is
+                        split into n_jobs shards that are sent to the
+                        workers once; A and O reach them through shared
+                        memory, and the parent sums their expected counts
+                        before the M-step.
+
+            tol:        If given, training stops early once an iteration
+                        improves the log-likelihood of X by less than tol
+                        relative to the previous iteration.
+
+            verbose:    Whether to print progress every 10 iterations.
+
+            checkpoint: If given, the file to periodically save the
+                        training state to: A, O, the number of completed
+                        iterations, the log-likelihood history and the
+                        states of the random number generators. Each save
+                        atomically replaces the previous one. It needs
+                        checkpoint_every or checkpoint_seconds.
+
+            checkpoint_every: Save a checkpoint every this many iterations.
+
+            checkpoint_seconds: Save a checkpoint once this many seconds
+                        have passed since the last one.
+
+            resume_from: If given, a checkpoint file to continue training
+                        from, exactly where it stopped. N_iters still counts
+                        the iterations done before the checkpoint.
+
+            low_memory: Whether to run forward-backward on each sequence
+                        keeping alphas only at about sqrt(M) checkpoints and
+                        recomputing the segments between them during the
+                        backward pass. This needs O(sqrt(M) L) memory per
+                        sequence instead of O(M L), so X can hold very long
+                        sequences such as whole sonnets or corpus streams.
+                        It cannot be combined with bucket_width.
+
+            callbacks:  A list of functions called at the end of every
+                        iteration with a dictionary of its statistics, with
+                        the keys 'iteration', 'log_likelihood',
+                        'converged', 'e_step_seconds', 'm_step_seconds',
+                        'iteration_seconds', 'forward_backward_seconds'
+                        (the part of the E-step spent in the forward and
+                        backward passes, that of the slowest worker when
+                        n_jobs > 1, so that it stays a part of the E-step's
+                        wall time), 'sequences_per_second' (len(X) over the
+                        iteration time) and 'peak_memory_bytes' (None
+                        unless trace_memory is set). HMM_report's
+                        JSONLinesReporter writes them to a file.
+
+            trace_memory: Whether to trace the peak memory of each iteration
+                        with tracemalloc. When n_jobs > 1, the workers are
+                        traced too, and the largest peak of any one process
+                        is reported. Tracing slows training down.
+
+        Returns:
+            log_probs:  The log-likelihood of X at the start of each
+                        iteration, i.e. under the parameters that the
+                        iteration's E-step used.
         '''
 
         # Note that a comment starting with 'E' refers to the fact that
@@ -200,351 +377,1837 @@ class HiddenMarkovModel:
         # Similarly, a comment starting with 'M' refers to the fact that
         # the code under the comment is part of the M-step.
 
-        for iteration in range(1, N_iters + 1):
-            if iteration % 10 == 0:
-                print("Iteration: " + str(iteration))
-
-            # Numerator and denominator for the update terms of A and O.
-            A_num = [[0. for i in range(self.L)] for j in range(self.L)]
-            O_num = [[0. for i in range(self.D)] for j in range(self.L)]
-            A_den = [0. for i in range(self.L)]
-            O_den = [0. for i in range(self.L)]
-
-            # For each input sequence:
-            for x in X:
-                M = len(x)
-                # Compute the alpha and beta probability vectors.
-                alphas = self.forward(x, normalize=True)
-                betas = self.backward(x, normalize=True)
-
-                # E: Update the expected observation probabilities for a
-                # given (x, y).
-                # The i^th index is P(y^t = i, x).
-                for t in range(1, M + 1):
-                    P_curr = [0. for _ in range(self.L)]
-                    
-                    for curr in range(self.L):
-                        P_curr[curr] = alphas[t][curr] * betas[t][curr]
-
-                    # Normalize the probabilities.
-                    norm = sum(P_curr)
-                    for curr in range(len(P_curr)):
-                        P_curr[curr] /= norm
-
-                    for curr in range(self.L):
-                        if t != M:
-                            A_den[curr] += P_curr[curr]
-                        O_den[curr] += P_curr[curr]
-                        O_num[curr][x[t - 1]] += P_curr[curr]
-
-                # E: Update the expectedP(y^j = a, y^j+1 = b, x) for given (x, y)
-                for t in range(1, M):
-                    P_curr_nxt = [[0. for _ in range(self.L)] for _ in range(self.L)]
-
-                    for curr in range(self.L):
-                        for nxt in range(self.L):
-                            P_curr_nxt[curr][nxt] = alphas[t][curr] \
-                                                    * self.A[curr][nxt] \
-                                                    * self.O[nxt][x[t]] \
-                                                    * betas[t + 1][nxt]
-
-                    # Normalize:
-                    norm = 0
-                    for lst in P_curr_nxt:
-                        norm += sum(lst)
-                    for curr in range(self.L):
-                        for nxt in range(self.L):
-                            P_curr_nxt[curr][nxt] /= norm
-
-                    # Update A_num
-                    for curr in range(self.L):
-                        for nxt in range(self.L):
-                            A_num[curr][nxt] += P_curr_nxt[curr][nxt]
-
-            for curr in range(self.L):
-                for nxt in range(self.L):
-                    self.A[curr][nxt] = A_num[curr][nxt] / A_den[curr]
-
-            for curr in range(self.L):
-                for xt in range(self.D):
-                    self.O[curr][xt] = O_num[curr][xt] / O_den[curr]
+        if low_memory and bucket_width is not None:
+            raise ValueError("low_memory cannot be combined with bucket_width")
+
+        if checkpoint is not None and checkpoint_every is None \
+                and checkpoint_seconds is None:
+            raise ValueError("checkpoint needs checkpoint_every or "
+                             "checkpoint_seconds")
+
+        log_probs = []
+        first_iteration = 1
+
+        if resume_from is not None:
+            state = load_checkpoint(resume_from)
+            if np.shape(state['O']) != (self.L, self.D):
+                raise ValueError("The checkpoint " + resume_from
+                                 + " does not match the shape of this HMM")
+
+            self._set_parameters(state['A'], state['O'])
+
+            log_probs = state['log_probs']
+            first_iteration = state['iteration'] + 1
+            random.setstate(state['random_state'])
+            np.random.set_state(state['numpy_state'])
+
+        # Every worker needs at least one sequence.
+        n_jobs = max(1, min(n_jobs, len(X)))
+
+        if n_jobs > 1:
+            params = multiprocessing.RawArray(self.dtype.char,
+                                              self.L * (self.L + self.D))
+            A_shared, O_shared = _parameter_views(params, self.L, self.D,
+                                                  self.dtype)
+            shards = [X[i::n_jobs] for i in range(n_jobs)]
+
+            pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                        initargs=(params, self.L, self.D,
+                                                  self.dtype, shards,
+                                                  bucket_width, low_memory,
+                                                  trace_memory))
+        elif bucket_width is not None:
+            data = _length_buckets(X, bucket_width)
+        else:
+            data = X
+
+        last_checkpoint = time.time()
+
+        started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        try:
+            for iteration in range(first_iteration, N_iters + 1):
+                iteration_start = time.perf_counter()
+                if trace_memory:
+                    tracemalloc.reset_peak()
+
+                # E: Accumulate the expected counts of each input sequence.
+                timings = {'forward_backward': 0.}
+
+                if n_jobs > 1:
+                    A_shared[:] = self.A
+                    O_shared[:] = self.O
+
+                    counts = pool.map(_shard_counts, range(n_jobs))
+                    A_num, A_den, O_num, O_den, log_prob, seconds, peaks = \
+                        zip(*counts)
+                    A_num, A_den, O_den, log_prob = \
+                        sum(A_num), sum(A_den), sum(O_den), sum(log_prob)
+                    O_num = _sparse_sum([pair for shard in O_num
+                                         for pair in shard], self.L)
+                    # The workers run at the same time, so the E-step waits
+                    # for the slowest of them.
+                    timings['forward_backward'] = max(seconds)
+                else:
+                    peaks = ()
+                    A_num, A_den, O_num, O_den, log_prob = \
+                        self._corpus_counts(data, bucket_width is not None,
+                                            low_memory, timings)
+
+                log_probs.append(float(log_prob))
+                m_step_start = time.perf_counter()
+
+                if verbose and iteration % 10 == 0:
+                    print("Iteration: " + str(iteration)
+                          + "\tLog-likelihood: " + str(log_probs[-1]))
+
+                # Stop once the previous M-step barely improved the fit.
+                converged = tol is not None and len(log_probs) > 1 and \
+                    log_probs[-1] - log_probs[-2] < tol * abs(log_probs[-2])
+
+                if converged:
+                    if verbose:
+                        print("Converged after " + str(iteration - 1)
+                              + " iterations")
+                else:
+                    # M: Normalize the expected counts row by row.
+                    A = A_num / A_den[:, None]
+                    # Only the columns of observed symbols can be nonzero.
+                    symbols, O_num = O_num[0]
+                    O = np.zeros((self.L, self.D))
+                    O[:, symbols] = O_num / O_den[:, None]
+
+                    self._set_parameters(A, O)
+
+                m_step_end = time.perf_counter()
+
+                if not converged and checkpoint is not None and (
+                        (checkpoint_every is not None
+                         and iteration % checkpoint_every == 0)
+                        or (checkpoint_seconds is not None
+                            and time.time() - last_checkpoint
+                                >= checkpoint_seconds)):
+                    save_checkpoint(checkpoint, self, iteration, log_probs)
+                    last_checkpoint = time.time()
+
+                if callbacks:
+                    seconds = time.perf_counter() - iteration_start
+                    peak_memory = None
+                    if trace_memory:
+                        peak_memory = max((tracemalloc.get_traced_memory()[1],)
+                                          + peaks)
+
+                    stats = {
+                        'iteration': iteration,
+                        'log_likelihood': log_probs[-1],
+                        'converged': converged,
+                        'e_step_seconds': m_step_start - iteration_start,
+                        'forward_backward_seconds':
+                            timings['forward_backward'],
+                        'm_step_seconds': m_step_end - m_step_start,
+                        'iteration_seconds': seconds,
+                        'sequences_per_second': len(X) / seconds,
+                        'peak_memory_bytes': peak_memory,
+                    }
+                    for callback in callbacks:
+                        callback(stats)
+
+                if converged:
+                    break
+        finally:
+            if n_jobs > 1:
+                pool.close()
+                pool.join()
+            if started_tracing:
+                tracemalloc.stop()
+
+        return log_probs
+
+
+    def online_learning(self, X, batch_size=100, kappa=0.7, t0=2,
+                        bucket_width=1, verbose=True):
+        '''
+        Trains the HMM using stepwise (online) EM, updating A and O after
+        every mini-batch instead of after full passes over the data. The
+        running expected counts are interpolated towards each mini-batch's
+        expected counts with a decaying step size (k + t0)^(-kappa), where k
+        is the number of batches seen so far.
 
+        Arguments:
+            X:          An iterable of input sequences, each a list of
+                        integers ranging from 0 to D - 1. It is consumed
+                        lazily, so it may be a generator over a corpus that
+                        does not fit in memory.
 
-    def generate_emission(self, M):
+            batch_size: Number of sequences per mini-batch.
+
+            kappa:      Decay rate of the step size, in (0.5, 1]. Smaller
+                        values forget old batches faster.
+
+            t0:         Offset of the step size, at least 1. Larger values
+                        damp the first few updates.
+
+            bucket_width: Bucket width used for the batched E-step of each
+                        mini-batch (see unsupervised_learning).
+
+            verbose:    Whether to print progress every 10 batches.
+
+        Returns:
+            log_probs:  The log-likelihood of each mini-batch under the
+                        parameters in place when it was processed.
         '''
-        Generates an emission of length M, assuming that the starting state
-        is chosen uniformly at random. 
+
+        # The running counts start out as the current parameters, i.e. as
+        # one pseudo-count per state.
+        A_num = np.array(self.A, dtype=float)
+        O_num = np.array(self.O, dtype=float)
+
+        X = iter(X)
+        log_probs = []
+
+        while True:
+            batch = list(itertools.islice(X, batch_size))
+            if len(batch) == 0:
+                break
+
+            # E: Average the expected counts over the mini-batch.
+            batch_A_num, _, batch_O_num, _, log_prob = self._corpus_counts(
+                _length_buckets(batch, bucket_width), True)
+            symbols, batch_O_num = batch_O_num[0]
+
+            # Take a step towards the mini-batch's counts.
+            step = (len(log_probs) + t0) ** -kappa
+
+            A_num *= 1 - step
+            A_num += step * batch_A_num / len(batch)
+            O_num *= 1 - step
+            O_num[:, symbols] += step * batch_O_num / len(batch)
+
+            log_probs.append(float(log_prob))
+
+            if verbose and len(log_probs) % 10 == 0:
+                print("Batch: " + str(len(log_probs))
+                      + "\tLog-likelihood: " + str(log_probs[-1]))
+
+            # M: Normalize the running counts row by row.
+            self._set_parameters(A_num / A_num.sum(axis=1, keepdims=True),
+                                 O_num / O_num.sum(axis=1, keepdims=True))
+
+        return log_probs
+
+
+    def _corpus_counts(self, data, batched, low_memory=False, timings=None):
+        '''
+        Computes the E-step of the Baum-Welch algorithm over a dataset.
 
         Arguments:
-            M:          Length of the emission to generate.
+            data:       Either a list of input sequences, or a list of
+                        (seqs, mask) buckets from _length_buckets.
+
+            batched:    Whether data holds buckets.
+
+            low_memory: Whether to use _checkpointed_expected_counts for
+                        each sequence.
+
+            timings:    If given, a dictionary whose 'forward_backward'
+                        entry the time spent in the forward and backward
+                        passes is added to.
 
         Returns:
-            emission:   The randomly generated emission as a list.
+            A_num, A_den, O_num, O_den: The expected counts described in
+                        _expected_counts, summed over the dataset. O_num
+                        is merged into a single (symbols, counts) pair.
 
-            states:     The randomly generated states as a list.
+            log_prob:   The log-likelihood of the dataset.
         '''
 
-        emission = []
-        state = random.choice(range(self.L))
-        states = []
+        # Numerator and denominator for the update terms of A and O.
+        A_num = np.zeros((self.L, self.L))
+        O_num = []
+        A_den = np.zeros(self.L)
+        O_den = np.zeros(self.L)
+        log_prob = 0.
+
+        if batched:
+            for seqs, mask in data:
+                log_prob += self._batch_expected_counts(
+                    seqs, mask, A_num, A_den, O_num, O_den, timings).sum()
+        else:
+            # Empty sequences have no counts, and the kernels assume at
+            # least one timestep.
+            expected_counts = self._checkpointed_expected_counts \
+                if low_memory else self._expected_counts
 
-        for t in range(M):
-            # Append state.
-            states.append(state)
+            for x in data:
+                if len(x) > 0:
+                    log_prob += expected_counts(x, A_num, A_den, O_num, O_den,
+                                                timings)
 
-            # Sample next observation.
-            rand_var = random.uniform(0, 1)
-            next_obs = 0
+        return A_num, A_den, _sparse_sum(O_num, self.L), O_den, log_prob
 
-            while rand_var > 0:
-                rand_var -= self.O[state][next_obs]
-                next_obs += 1
 
-            next_obs -= 1
-            emission.append(next_obs)
+    def _expected_counts(self, x, A_num, A_den, O_num, O_den, timings=None):
+        '''
+        Computes the E-step of the Baum-Welch algorithm for a single input
+        sequence and adds the expected counts into the given accumulators.
 
-            # Sample next state.
-            rand_var = random.uniform(0, 1)
-            next_state = 0
+        Arguments:
+            x:          Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
 
-            while rand_var > 0:
-                rand_var -= self.A[state][next_state]
-                next_state += 1
+            A_num:      L x L array of expected transition counts.
 
-            next_state -= 1
-            state = next_state
+            A_den:      Length L array of expected visits to each state,
+                        excluding the last timestep.
 
-        return emission, states
+            O_num:      List of sparse expected observation counts. A
+                        (symbols, counts) pair is appended to it, where
+                        counts is an L x len(symbols) array holding the
+                        counts of only the symbols in x. The pairs are
+                        merged with _sparse_sum.
+
+            O_den:      Length L array of expected visits to each state.
 
+            timings:    Optional dictionary of timings, see _corpus_counts.
 
-    def generate_line(self, syllables, syllable_dict, reverse=False, initial=None):
+        Returns:
+            log_prob:   The log-likelihood log P(x) under the current model.
         '''
-        Generates an emission with a set number of syllables, assuming that the 
-        starting state is chosen uniformly at random. 
+
+        A, O, _ = self._arrays()
+
+        start = time.perf_counter()
+        alphas, scales = self.scaled_forward(x)
+        betas = self.scaled_backward(x, scales)
+        if timings is not None:
+            timings['forward_backward'] += time.perf_counter() - start
+
+        # E: The (t, i)^th element is P(y^t = i | x).
+        gammas = alphas * betas
+        gammas /= gammas.sum(axis=1, keepdims=True)
+
+        # E: Sum P(y^t = a, y^t+1 = b | x) over t in a single contraction.
+        # The scaling makes each timestep's term sum to one already.
+        weights = O[:, x[1:]].T * betas[1:] / scales[1:, None]
+        A_num += A * np.einsum('ti,tj->ij', alphas[:-1], weights)
+
+        A_den += gammas[:-1].sum(axis=0)
+        O_den += gammas.sum(axis=0)
+
+        # E: Scatter-add the state posteriors into the observed columns.
+        O_num.append((np.asarray(x), gammas.T))
+
+        return np.log(scales).sum()
+
+
+    def _checkpointed_expected_counts(self, x, A_num, A_den, O_num, O_den,
+                                      timings=None):
+        '''
+        Memory-efficient version of _expected_counts for long sequences.
+        The forward pass keeps only every s^th alpha, where s is about
+        sqrt(M), and the backward pass recomputes the alphas of one segment
+        of s timesteps at a time from its checkpoint. Everything works with
+        scaled alphas and betas, so it neither underflows nor needs more than
+        O(sqrt(M) L) memory beyond the sparse observation counts, which hold
+        about one column per distinct symbol in x.
+
+        Arguments and return value as in _expected_counts.
+        '''
+
+        A, O, A_start = self._arrays()
+        M = len(x)
+        s = max(1, int(np.ceil(np.sqrt(M))))
+
+        # Time spent in the forward pass and in recomputing each segment's
+        # alphas and betas.
+        start_time = time.perf_counter()
+        seconds = 0.
+
+        # Forward pass, one segment at a time, keeping only what each
+        # segment's first alpha is computed from: A_start for the first
+        # segment, and the previous alpha times A for the others.
+        x = np.asarray(x)
+        priors = []
+        log_prob = 0.
+
+        prior = A_start
+        for start in range(0, M, s):
+            emissions = np.ascontiguousarray(O[:, x[start:start + s]].T)
+            alphas, scales = HMM_kernels.forward(A, emissions, prior)
+
+            priors.append(prior)
+            log_prob += np.log(scales).sum()
+            prior = alphas[-1] @ A
+
+        # Backward pass over the segments, last to first. The beta, scale
+        # and emissions just past the current segment carry over from the
+        # segment after it.
+        beta_next = None
+
+        # Sparse observation counts of the segments since the last merge.
+        # They are merged whenever they hold more than limit columns, so
+        # they stay within a constant factor of the distinct symbols seen.
+        pending = []
+        pending_columns = 0
+        limit = 2 * s
+
+        seconds += time.perf_counter() - start_time
+
+        for start in range(s * (len(priors) - 1), -1, -s):
+            start_time = time.perf_counter()
+
+            end = min(start + s, M)
+            emissions = np.ascontiguousarray(O[:, x[start:end]].T)
+
+            # Recompute the segment's alphas and scales.
+            alphas, scales = HMM_kernels.forward(A, emissions,
+                                                 priors[start // s])
+
+            # Compute the segment's betas, continuing from the next segment.
+            if beta_next is None:
+                last = np.ones(self.L)
+            else:
+                last = A @ (emissions_next * beta_next) / scale_next
+
+            betas = HMM_kernels.backward(A, emissions, scales, last)
+
+            seconds += time.perf_counter() - start_time
+
+            # E: State posteriors of the segment.
+            gammas = alphas * betas
+            gammas /= gammas.sum(axis=1, keepdims=True)
+
+            # E: Transition posteriors, including the transition out of the
+            # segment's last timestep when there is a next segment.
+            weights = emissions[1:] * betas[1:] / scales[1:, None]
+            A_num += A * np.einsum('ti,tj->ij', alphas[:-1], weights)
+
+            if beta_next is not None:
+                A_num += A * np.outer(alphas[-1], emissions_next * beta_next
+                                      / scale_next)
+                A_den += gammas.sum(axis=0)
+            else:
+                A_den += gammas[:-1].sum(axis=0)
+
+            O_den += gammas.sum(axis=0)
+
+            # E: Observation counts of the segment, merged when they pile up.
+            pending.append((x[start:end], gammas.T))
+            pending_columns += end - start
+            if pending_columns > limit:
+                pending = _sparse_sum(pending, self.L)
+                pending_columns = len(pending[0][0])
+                limit = 2 * max(pending_columns, s)
+
+            beta_next, scale_next, emissions_next = \
+                betas[0], scales[0], emissions[0]
+
+        O_num.extend(_sparse_sum(pending, self.L))
+
+        if timings is not None:
+            timings['forward_backward'] += seconds
+
+        return log_prob
+
+
+    def _batch_forward(self, emissions, mask):
+        '''
+        Batched version of scaled_forward for padded sequences. Padded
+        positions carry the last alpha forward with a scale of one, so they
+        do not affect the likelihood.
 
         Arguments:
-            syllables:     Number of syllables in the emission to generate.
-            syllable_dict: Information about the syllables of each word.
-            reverse:       Whether to perform generaation forwards or backwards.
-            initial:       The initial observation in the generated output.
+            emissions:  Array of shape (B, T, L) whose (b, t, j)^th element
+                        is P(x_b^t | y^t = j).
+
+            mask:       Boolean array of shape (B, T) that is True on the
+                        real (non-padded) positions.
 
         Returns:
-            emission:      The randomly generated emission as a list.
+            alphas:     Array of shape (B, T, L) of normalized alphas.
 
-            states:        The randomly generated states as a list.
+            scales:     Array of shape (B, T) of scaling factors.
         '''
-        
-        emission = []
-        states = []
-        state = None
-        
-        normal_syllable_count = [0]
-        end_syllable_count = [0]
-        
-        # Reverse the transitions matrix if we're generating backwards
-        transitions = self.A
-        if reverse:
-            #transitions = list(map(list, zip(*self.A)))
-            transitions = np.array(transitions).T.tolist()
-            
-            # Renormalize each row of the transitions matrix
-            for i in range(len(transitions)):
-                transitions[i] = [transitions[i][j]/sum(transitions[i]) for j in range(len(transitions[i]))] 
-        
-        if initial != None:
-            # We have the initial word for this line already
-            emission.append(initial)
-            
-            normal_syllable_count = syllable_dict[initial]['normal']
-            end_syllable_count = normal_syllable_count + syllable_dict[initial]['end'] 
-            
-            # Find the probability that a given state would generate this word
-            prob_states = list(map(list, zip(*self.O)))[initial]
-            prob_states = [prob_states[i]/sum(prob_states) for i in range(len(prob_states))]
-            
-            # Sample the initial state for this word
-            rand_var = random.uniform(0, 1)
-            initial_state = 0
 
-            while rand_var > 0:
-                rand_var -= prob_states[initial_state]
-                initial_state += 1
+        A, _, A_start = self._arrays()
 
-            initial_state -= 1
-            states.append(initial_state)
-            
-            # Sample the next state as well using the initial state
-            rand_var = random.uniform(0, 1)
-            next_state = 0
+        return HMM_kernels.batch_forward(A, np.ascontiguousarray(emissions),
+                                         A_start, mask)
 
-            while rand_var > 0:
-                rand_var -= transitions[initial_state][next_state]
-                next_state += 1
 
-            next_state -= 1
-            state = next_state
-        else:
-            # We don't have anything; just pick an initial state
-            state = random.choice(range(self.L))
-                
-        # Generate words until we reach the requested number of syllables
-        while syllables not in end_syllable_count:
-            # Add the state to the beginning or end of the state list
-            if reverse:
-                states.insert(0, state)
-            else:
-                states.append(state)
+    def _batch_expected_counts(self, seqs, mask, A_num, A_den, O_num, O_den,
+                               timings=None):
+        '''
+        Batched version of _expected_counts for a bucket of padded sequences.
+        The forward and backward recursions run over a (batch, L) array per
+        timestep, and padded positions leave the recursions unchanged.
 
-            # Sample next observation.
-            rand_var = random.uniform(0, 1)
-            next_obs = 0
-            
-            # Zero out the weights of words whose syllables would not fit in this line
-            possible_emissions = list(self.O[state])
-            for i in range(len(possible_emissions)):
-                if i not in syllable_dict:
-                    possible_emissions[i] = 0
-                else:
-                    word_syllables = syllable_dict[i]['normal'] + syllable_dict[i]['end']
-                    if min(normal_syllable_count) + min(word_syllables) > 10:
-                        possible_emissions[i] = 0
-            possible_emissions = [possible_emissions[i]/sum(possible_emissions) for i in range(len(possible_emissions))]
+        Arguments:
+            seqs:       Integer array of shape (B, T) holding B sequences
+                        padded to length T.
 
-            while rand_var > 0:
-                rand_var -= possible_emissions[next_obs]
-                next_obs += 1
+            mask:       Boolean array of shape (B, T) that is True on the
+                        real (non-padded) positions of seqs.
 
-            next_obs -= 1
-            
-            # Add the emission to the beginning or end of the emission list
-            if reverse:
-                emission.insert(0, next_obs)
-            else:
-                emission.append(next_obs)
-            
-            # Keep track of how many syllables this line could have
-            obs_syllables_normal = syllable_dict[next_obs]['normal']
-            obs_syllables_end = syllable_dict[next_obs]['end']
-            
-            new_normal_syllable_count = []
-            new_end_syllable_count = []
-            
-            for i in range(len(normal_syllable_count)):
-                # Add syllables in this word to syllables of the line
-                for j in range(len(obs_syllables_normal)):
-                    new_normal_syllable_count.append(normal_syllable_count[i] + obs_syllables_normal[j])
-                    
-                # Include all previous possibilies plus the end possibilies for this word
-                new_end_syllable_count = list(new_normal_syllable_count)
-                for j in range(len(obs_syllables_end)):
-                    new_end_syllable_count.append(normal_syllable_count[i] + obs_syllables_end[j])
-                    
-            # Update the syllable counts
-            normal_syllable_count = new_normal_syllable_count
-            end_syllable_count = new_end_syllable_count
-                
-            # Sample next state.
-            rand_var = random.uniform(0, 1)
-            next_state = 0
+            A_num, A_den, O_num, O_den: The accumulators described in
+                        _expected_counts.
 
-            while rand_var > 0:
-                rand_var -= transitions[state][next_state]
-                next_state += 1
+            timings:    Optional dictionary of timings, see _corpus_counts.
 
-            next_state -= 1
-            state = next_state
+        Returns:
+            log_probs:  Array of length B holding log P(x) for each sequence.
+        '''
 
-        return emission, states
-            
-    
-    def save(self, filename):
-        ''' Save the HMM to file. '''
-        
-        file = open(filename, 'w')
-        
-        # Save the parameters
-        file.write(str(self.L) + "\t" + str(self.D) + "\n")
-        
-        # Save the transition matrix
-        for i in range(len(self.A)):
-            file.write("\t".join(str(x) for x in self.A[i]) + "\n")
-        
-        # Save the observation matrix
-        for i in range(len(self.O)):
-            file.write("\t".join(str(x) for x in self.O[i]) + "\n")
-            
-        file.close()
-        
+        A, O, _ = self._arrays()
 
-def load(filename):
-    ''' Load an HMM from file. '''
-    
-    A = []
-    O = []
-    
-    file = open(filename, 'r')
-    
-    # Read the parameters
-    L, D = [int(x) for x in file.readline().strip().split('\t')]
+        # The (b, t, j)^th element is P(x_b^t | y^t = j).
+        emissions = np.ascontiguousarray(O[:, seqs].transpose(1, 2, 0))
 
-    # Read the transition matrix
-    for i in range(L):
-        A.append([float(x) for x in file.readline().strip().split('\t')])
+        start = time.perf_counter()
+        alphas, scales = self._batch_forward(emissions, mask)
 
-    # Read the observation matrix
-    for i in range(L):
-        O.append([float(x) for x in file.readline().strip().split('\t')])
-        
-    file.close()
-    
-    return HiddenMarkovModel(A, O)
-            
+        # Backward pass. Betas stay at one until a sequence's last position.
+        betas = HMM_kernels.batch_backward(A, emissions, scales, mask)
 
-def unsupervised_HMM(X, n_states, N_iters):
-    '''
-    Helper function to train an unsupervised HMM. The function determines the
-    number of unique observations in the given data, initializes
-    the transition and observation matrices, creates the HMM, and then runs
-    the training function for unsupervised learing.
+        if timings is not None:
+            timings['forward_backward'] += time.perf_counter() - start
 
-    Arguments:
-        X:          A dataset consisting of input sequences in the form
-                    of lists of variable length, consisting of integers 
-                    ranging from 0 to D - 1. In other words, a list of lists.
+        # E: State posteriors, zeroed on padded positions.
+        gammas = alphas * betas
+        gammas /= gammas.sum(axis=2, keepdims=True)
+        gammas *= mask[:, :, None]
 
-        n_states:   Number of hidden states to use in training.
-        
-        N_iters:    The number of iterations to train on.
-    '''
+        # E: Transition posteriors summed over the batch and time. A
+        # transition into a padded position contributes nothing.
+        weights = emissions[:, 1:] * betas[:, 1:] / scales[:, 1:, None] \
+                  * mask[:, 1:, None]
+        A_num += A * np.einsum('bti,btj->ij', alphas[:, :-1], weights)
 
-    # Make a set of observations.
-    observations = set()
-    for x in X:
-        observations |= set(x)
-    
-    # Compute L and D.
-    L = n_states
-    D = len(observations)
+        A_den += (gammas[:, :-1] * mask[:, 1:, None]).sum(axis=(0, 1))
+        O_den += gammas.sum(axis=(0, 1))
 
-    # Randomly initialize and normalize matrices A and O.
-    A = [[random.random() for i in range(L)] for j in range(L)]
+        O_num.append((seqs[mask], gammas[mask].T))
 
-    for i in range(len(A)):
-        norm = sum(A[i])
-        for j in range(len(A[i])):
-            A[i][j] /= norm
-    
-    # Randomly initialize and normalize matrix O.
-    O = [[random.random() for i in range(D)] for j in range(L)]
+        return np.log(scales).sum(axis=1)
 
-    for i in range(len(O)):
-        norm = sum(O[i])
-        for j in range(len(O[i])):
-            O[i][j] /= norm
 
-    # Train an HMM with unlabeled data.
-    HMM = HiddenMarkovModel(A, O)
-    HMM.unsupervised_learning(X, N_iters)
+    def score(self, x):
+        '''
+        Calculates the log-likelihood of an input sequence.
 
-    return HMM
+        Arguments:
+            x:          Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+        Returns:
+            log_prob:   log P(x), computed from the scaling factors of the
+                        forward algorithm so that it does not underflow.
+        '''
+
+        if len(x) == 0:
+            return 0.
+
+        return float(np.log(self.scaled_forward(x)[1]).sum())
+
+
+    def score_batch(self, X, batch_size=4096):
+        '''
+        Calculates the log-likelihoods of many input sequences at once, along
+        with their perplexity. The sequences are sorted by length and scored
+        batch_size at a time with a single padded forward pass.
+
+        Arguments:
+            X:          A list of input sequences, each a list of integers
+                        ranging from 0 to D - 1.
+
+            batch_size: Number of sequences scored together.
+
+        Returns:
+            log_probs:  Array holding log P(x) for each sequence in X.
+
+            perplexity: exp(-sum(log_probs) / N), where N is the total
+                        number of observations in X.
+        '''
+
+        _, O, _ = self._arrays()
+        log_probs = np.zeros(len(X))
+
+        order = sorted((i for i in range(len(X)) if len(X[i]) > 0),
+                       key=lambda i: len(X[i]))
+
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            seqs, mask = _pad_sequences([X[i] for i in indices])
+
+            _, scales = self._batch_forward(O[:, seqs].transpose(1, 2, 0),
+                                            mask)
+            log_probs[indices] = np.log(scales).sum(axis=1)
+
+        N = sum(len(x) for x in X)
+        perplexity = float(np.exp(-log_probs.sum() / N)) if N > 0 else 1.
+
+        return log_probs, perplexity
+
+
+    def _log_arrays(self):
+        '''
+        Returns the logarithms of A, O and A_start, cached until the
+        parameters change.
+        '''
+
+        if 'log_arrays' not in self._cache:
+            with np.errstate(divide='ignore'):
+                self._cache['log_arrays'] = tuple(np.log(array)
+                                                  for array in self._arrays())
+
+        return self._cache['log_arrays']
+
+
+    def viterbi(self, x):
+        '''
+        Uses the Viterbi algorithm to find the max probability state
+        sequence corresponding to a given input sequence.
+
+        Arguments:
+            x:          Input sequence in the form of a list of length M,
+                        consisting of integers ranging from 0 to D - 1.
+
+        Returns:
+            states:     The max probability state sequence as a list of
+                        length M.
+        '''
+
+        return self.viterbi_batch([x])[0]
+
+
+    def viterbi_batch(self, X, batch_size=None):
+        '''
+        Runs the Viterbi algorithm on many input sequences at once. The
+        sequences are sorted by length and decoded batch_size at a time as
+        padded arrays, with one (batch, L, L) maximization per timestep.
+
+        Arguments:
+            X:          A list of input sequences, each a list of integers
+                        ranging from 0 to D - 1.
+
+            batch_size: Number of sequences decoded together. By default,
+                        as many as keep the (batch, L, L) array of each
+                        timestep to about 64 MB.
+
+        Returns:
+            states:     A list holding the max probability state sequence
+                        of each input sequence, in the same order as X.
+        '''
+
+        log_A, log_O, log_start = self._log_arrays()
+        states = [[] for _ in X]
+
+        if batch_size is None:
+            batch_size = max(1, 2 ** 23 // self.L ** 2)
+
+        # Sorting by length keeps the padding in each batch small.
+        order = sorted((i for i in range(len(X)) if len(X[i]) > 0),
+                       key=lambda i: len(X[i]))
+
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            seqs, mask = _pad_sequences([X[i] for i in indices])
+            B, T = seqs.shape
+
+            # The (b, j)^th score is the max log probability of a path
+            # ending in state j. Padded positions keep their scores and
+            # point back to the same state.
+            scores = log_start + log_O[:, seqs[:, 0]].T
+            pointers = np.empty((B, T, self.L), dtype=int)
+            pointers[:, 0] = np.arange(self.L)
+
+            for t in range(1, T):
+                candidates = scores[:, :, None] + log_A
+                best = candidates.argmax(axis=1)
+                best_scores = np.take_along_axis(candidates, best[:, None],
+                                                 axis=1)[:, 0]
+
+                scores = np.where(mask[:, t, None],
+                                  best_scores + log_O[:, seqs[:, t]].T, scores)
+                pointers[:, t] = np.where(mask[:, t, None], best,
+                                          np.arange(self.L))
+
+            # Follow the pointers back from the best final states.
+            paths = HMM_kernels.backtrack(pointers, scores.argmax(axis=1))
+
+            for b, i in enumerate(indices):
+                states[i] = paths[b, :len(X[i])].tolist()
+
+        return states
+
+
+    def generate_emission(self, M):
+        '''
+        Generates an emission of length M, assuming that the starting state
+        is chosen uniformly at random. 
+
+        Arguments:
+            M:          Length of the emission to generate.
+
+        Returns:
+            emission:   The randomly generated emission as a list.
+
+            states:     The randomly generated states as a list.
+        '''
+
+        emission = []
+        state = random.choice(range(self.L))
+        states = []
+
+        A_cdfs, O_cdfs = self._cdfs()
+
+        for t in range(M):
+            # Append state.
+            states.append(state)
+
+            # Sample next observation.
+            emission.append(_sample(O_cdfs[state]))
+
+            # Sample next state.
+            state = _sample(A_cdfs[state])
+
+        return emission, states
+
+
+    def generate_emissions(self, K, M, seed=None):
+        '''
+        Generates K independent emissions of length M at once, advancing all
+        K Markov chains in lockstep with vectorized sampling. Each chain's
+        starting state is chosen uniformly at random.
+
+        Arguments:
+            K:          Number of emissions to generate.
+
+            M:          Length of each emission.
+
+            seed:       Seed or numpy.random.Generator used for sampling.
+
+        Returns:
+            emissions:  Integer array of shape (K, M) of observations.
+
+            states:     Integer array of shape (K, M) of hidden states.
+        '''
+
+        rng = np.random.default_rng(seed)
+        A_cdf, O_cdf = self._flat_cdfs()
+
+        emissions = np.empty((K, M), dtype=int)
+        states = np.empty((K, M), dtype=int)
+
+        state = rng.integers(self.L, size=K)
+
+        for t in range(M):
+            states[:, t] = state
+            emissions[:, t] = _sample_rows(O_cdf, self.D, state, rng)
+            state = _sample_rows(A_cdf, self.L, state, rng)
+
+        return emissions, states
+
+
+    def _flat_cdfs(self):
+        '''
+        Returns the normalized cumulative sums of the rows of A and of O,
+        with i added to row i and flattened, for sampling with _sample_rows.
+        They are cached until the parameters change.
+
+        The sums are always float64: with the row offsets added, float32
+        would not have enough precision left for small probabilities.
+        '''
+
+        if 'flat_cdfs' not in self._cache:
+            tables = []
+            for matrix in self._arrays()[:2]:
+                cdf = np.cumsum(matrix, axis=1, dtype=np.float64)
+                cdf /= cdf[:, -1:]
+                cdf += np.arange(len(cdf))[:, None]
+                tables.append(cdf.ravel())
+
+            self._cache['flat_cdfs'] = tuple(tables)
+
+        return self._cache['flat_cdfs']
+
+
+    def _cdfs(self):
+        '''
+        Returns the cumulative sums of the rows of A and of O as lists of
+        lists, for sampling with _sample. They are built once and cached
+        until the parameters change.
+        '''
+
+        if 'cdfs' not in self._cache:
+            A, O, _ = self._arrays()
+            self._cache['cdfs'] = (
+                np.cumsum(A, axis=1, dtype=np.float64).tolist(),
+                np.cumsum(O, axis=1, dtype=np.float64).tolist())
+
+        return self._cache['cdfs']
+
+
+    def generate_line(self, syllables, syllable_dict, reverse=False, initial=None,
+                      max_attempts=1000):
+        '''
+        Generates an emission with a set number of syllables, assuming that the 
+        starting state is chosen uniformly at random. 
+
+        Arguments:
+            syllables:     Number of syllables in the emission to generate.
+            syllable_dict: Information about the syllables of each word,
+                           either as a dictionary from parse_syllables or
+                           as a SyllableIndex.
+            reverse:       Whether to perform generaation forwards or backwards.
+            initial:       The initial observation in the generated output.
+            max_attempts:  How many times to start the line over when every
+                           way of counting its syllables overshoots.
+
+        Returns:
+            emission:      The randomly generated emission as a list.
+
+            states:        The randomly generated states as a list.
+        '''
+
+        if not isinstance(syllable_dict, SyllableIndex):
+            syllable_dict = self._syllable_index(syllable_dict)
+
+        _, O, _ = self._arrays()
+        masks = syllable_dict.masks(syllables)
+        syllable_dict = syllable_dict.syllable_dict
+
+        # The possible syllable counts of the line so far, as bitsets whose
+        # k^th bit is set if the line could have k syllables. Counts past
+        # the requested number can never help, so they are dropped.
+        within_line = (1 << (syllables + 1)) - 1
+
+        # Use the reversed transitions matrix if we're generating backwards
+        if reverse:
+            transition_cdfs = self._reversed_transitions()[1]
+        else:
+            transition_cdfs = self._cdfs()[0]
+        
+        if initial != None:
+            # The initial word's syllables, alone and as the end of the line
+            initial_normal_bits = _shift_bits(1, syllable_dict[initial]['normal']) & within_line
+            initial_end_bits = (initial_normal_bits | _shift_bits(1, syllable_dict[initial]['end'])) & within_line
+
+            if initial_normal_bits == 0 and not (initial_end_bits >> syllables) & 1:
+                raise ValueError("The initial word does not fit in a line of "
+                                 + str(syllables) + " syllables")
+
+        for attempt in range(max_attempts):
+            emission = []
+            states = []
+            normal_syllable_bits = 1
+            end_syllable_bits = 1
+
+            if initial != None:
+                # We have the initial word for this line already
+                emission.append(initial)
+
+                normal_syllable_bits = initial_normal_bits
+                end_syllable_bits = initial_end_bits
+
+                # Sample the initial state for this word from the probability
+                # that a given state would generate it
+                initial_state = _sample(self._word_states()[1][initial])
+                states.append(initial_state)
+
+                # Sample the next state as well using the initial state
+                state = _sample(transition_cdfs[initial_state])
+            else:
+                # We don't have anything; just pick an initial state
+                state = random.choice(range(self.L))
+
+            # Generate words until we reach the requested number of syllables
+            while not (end_syllable_bits >> syllables) & 1:
+                # If every way of counting the line overshoots, start over
+                if normal_syllable_bits == 0:
+                    break
+
+                # Add the state to the beginning or end of the state list
+                if reverse:
+                    states.insert(0, state)
+                else:
+                    states.append(state)
+
+                # Sample next observation, zeroing out the weights of words
+                # whose syllables would not fit in this line
+                used = (normal_syllable_bits & -normal_syllable_bits).bit_length() - 1
+                possible_emissions = O[state] * masks[used]
+
+                next_obs = _sample(np.cumsum(possible_emissions))
+
+                # Add the emission to the beginning or end of the emission list
+                if reverse:
+                    emission.insert(0, next_obs)
+                else:
+                    emission.append(next_obs)
+
+                # Keep track of how many syllables this line could have: add
+                # the syllables of this word to the syllables of the line, and
+                # include the end possibilities for this word
+                end_syllable_bits = _shift_bits(normal_syllable_bits, syllable_dict[next_obs]['end'])
+                normal_syllable_bits = _shift_bits(normal_syllable_bits, syllable_dict[next_obs]['normal']) & within_line
+                end_syllable_bits = (end_syllable_bits | normal_syllable_bits) & within_line
+
+                # Sample next state.
+                state = _sample(transition_cdfs[state])
+            else:
+                return emission, states
+
+        raise ValueError("Could not generate a line of " + str(syllables)
+                         + " syllables in " + str(max_attempts) + " attempts")
+
+
+    def generate_line_exact(self, syllables, syllable_dict, reverse=False,
+                            initial=None, seed=None):
+        '''
+        Generates an emission with exactly a set number of syllables in a
+        single pass, without overshooting or retrying. The line is sampled
+        from the HMM conditioned on its syllable count, using a lattice over
+        (hidden state, syllables remaining) built from A, O and the syllable
+        dictionary. Words with several possible syllable counts are treated
+        as one path per count.
+
+        Arguments:
+            syllables:     Number of syllables in the emission to generate,
+                           at least 1.
+            syllable_dict: Information about the syllables of each word,
+                           either as a dictionary from parse_syllables or
+                           as a SyllableIndex.
+            reverse:       Whether to perform generation forwards or
+                           backwards. When generating backwards, the first
+                           generated word is the last word of the line.
+            initial:       The initial observation in the generated output.
+            seed:          Seed or numpy.random.Generator used for sampling.
+
+        Returns:
+            emission:      The randomly generated emission as a list.
+
+            states:        The randomly generated states as a list.
+        '''
+
+        if not isinstance(syllable_dict, SyllableIndex):
+            syllable_dict = self._syllable_index(syllable_dict)
+
+        initials = None if initial is None else [initial]
+
+        return self._sample_lines(syllables, syllable_dict, reverse, initials,
+                                  1, np.random.default_rng(seed))[0]
+
+
+    def generate_lines_exact(self, syllables, syllable_dict, reverse=False,
+                             initials=None, K=1, seed=None):
+        '''
+        Batched version of generate_line_exact, which samples many lines
+        at once with vectorized sampling.
+
+        Arguments:
+            syllables:     Number of syllables in each line.
+            syllable_dict: Information about the syllables of each word,
+                           either as a dictionary from parse_syllables or
+                           as a SyllableIndex.
+            reverse:       Whether to perform generation forwards or
+                           backwards.
+            initials:      None, or a list of the initial observation of
+                           each line, in which case one line is generated
+                           per initial.
+            K:             Number of lines to generate, if initials is None.
+            seed:          Seed or numpy.random.Generator used for sampling.
+
+        Returns:
+            lines:         A list of (emission, states) pairs of lists.
+        '''
+
+        if not isinstance(syllable_dict, SyllableIndex):
+            syllable_dict = self._syllable_index(syllable_dict)
+
+        return self._sample_lines(syllables, syllable_dict, reverse, initials,
+                                  K, np.random.default_rng(seed))
+
+
+    def _sample_lines(self, syllables, index, reverse, initials, K, rng):
+        '''
+        Samples K lines with exactly a set number of syllables at once, as
+        described in generate_line_exact. All lines advance in lockstep with
+        vectorized sampling until each has used up its syllables.
+
+        Arguments:
+            syllables:  Number of syllables in each line.
+
+            index:      A SyllableIndex.
+
+            reverse:    Whether to generate backwards.
+
+            initials:   None, or a list of the initial word of each line, in
+                        which case K is taken to be its length.
+
+            K:          Number of lines, if initials is None.
+
+            rng:        A numpy.random.Generator.
+
+        Returns:
+            A list of K (emission, states) pairs of lists.
+        '''
+
+        if syllables < 1:
+            raise ValueError("A line needs at least one syllable")
+
+        S = syllables
+        lattice = self._line_lattice(S, index, reverse)
+        stop, cont, G, H = lattice['stop'], lattice['cont'], lattice['G'], \
+                           lattice['H']
+
+        _, O, _ = self._arrays()
+
+        # Choose the first word, its state and its syllable count.
+        if initials is None:
+            state = _sample_categorical(np.tile(lattice['G_first'], (K, 1)),
+                                        rng)
+            remaining = np.full(K, S)
+            words, counts = _lattice_step(O[state], state, remaining,
+                                          lattice['first_stop'],
+                                          lattice['first_cont'], H, rng)
+        else:
+            words = np.asarray(initials)
+            K = len(words)
+
+            # Weigh each (state, count) pair of the initial word by how
+            # likely the state is to generate it and the rest of the line.
+            word_states = self._word_states()[0][words]
+            completions = _completion_weights(
+                H, np.tile(np.arange(self.L), (K, 1)),
+                np.full((K, self.L), S))
+            options = word_states[:, :, None] * completions \
+                      * lattice['first_cont'][:, words].T[:, None, :]
+            options[:, :, S] += word_states \
+                                * lattice['first_stop'][S, words][:, None]
+
+            choices = _sample_categorical(options.reshape(K, -1), rng)
+            state, counts = np.divmod(choices, S + 1)
+
+        emissions = [[word] for word in words.tolist()]
+        states = [[y] for y in state.tolist()]
+        remaining = S - counts
+
+        # Keep adding words to the unfinished lines.
+        transitions = lattice['transitions']
+        active = np.nonzero(remaining > 0)[0]
+
+        while len(active) > 0:
+            state[active] = _sample_categorical(
+                transitions[state[active]] * G[remaining[active]], rng)
+            words, counts = _lattice_step(O[state[active]], state[active],
+                                          remaining[active], stop, cont, H,
+                                          rng)
+
+            for b, word, y in zip(active.tolist(), words.tolist(),
+                                  state[active].tolist()):
+                emissions[b].append(word)
+                states[b].append(y)
+
+            remaining[active] -= counts
+            active = active[remaining[active] > 0]
+
+        if reverse:
+            for emission, line_states in zip(emissions, states):
+                emission.reverse()
+                line_states.reverse()
+
+        return list(zip(emissions, states))
+
+
+    def _line_lattice(self, syllables, index, reverse):
+        '''
+        Builds the lattice used by _sample_lines, cached until the
+        parameters change.
+
+        For every number of syllables r and state i, G[r][i] is the total
+        weight of finishing a line with exactly r more syllables, starting
+        with a word emitted from state i. H[r][i] is the same for starting
+        with a transition out of state i. The last word of a line can use
+        its end syllable counts, and when generating backwards the last
+        word is generated first.
+
+        Words with zero syllables, such as "th'", leave r unchanged, so G[r]
+        depends on itself through H[r]: G[r] = b + c * (T @ G[r]), where c is
+        the weight of the zero-syllable words of each state and b the
+        weight of everything else. Each G[r] is found with a linear solve.
+
+        Returns:
+            lattice:    A dictionary with the transition matrix used for
+                        generation, the count tables ('stop' for a word that
+                        finishes the line, 'cont' for a word that does not,
+                        and 'first_stop' and 'first_cont' for the first
+                        generated word), G, H and the weight G_first of
+                        starting the line from each state.
+        '''
+
+        key = ('lattice', syllables, reverse)
+        cached = self._cache.get(key)
+
+        if cached is None or cached[0] is not index:
+            A, O, _ = self._arrays()
+            normal, final = index.count_tables(syllables)
+
+            if reverse:
+                transitions = self._reversed_transitions()[0]
+                stop, cont, first_cont = normal, normal, final
+            else:
+                transitions = A
+                stop, cont, first_cont = final, normal, normal
+
+            # The total emission weight of each (count, state) pair.
+            stop_weights = stop @ O.T
+            cont_weights = cont @ O.T
+
+            G = np.zeros((syllables + 1, self.L))
+            H = np.zeros((syllables + 1, self.L))
+
+            # (I - diag(c) T), the same for every r.
+            loops = np.eye(self.L) - cont_weights[0][:, None] * transitions
+
+            for r in range(1, syllables + 1):
+                b = stop_weights[r].copy()
+                for k in range(1, r):
+                    b += cont_weights[k] * H[r - k]
+                G[r] = np.linalg.solve(loops, b)
+                H[r] = transitions @ G[r]
+
+            G_first = (final[syllables] @ O.T).copy()
+            first_cont_weights = first_cont @ O.T
+            for k in range(0, syllables):
+                G_first += first_cont_weights[k] * H[syllables - k]
+
+            lattice = {'transitions': transitions, 'stop': stop,
+                       'cont': cont, 'first_stop': final,
+                       'first_cont': first_cont, 'G': G, 'H': H,
+                       'G_first': G_first}
+            cached = (index, lattice)
+            self._cache[key] = cached
+
+        return cached[1]
+
+
+    def _syllable_index(self, syllable_dict):
+        '''
+        Returns a SyllableIndex for a syllable dictionary, cached for as long
+        as the same dictionary is passed in.
+        '''
+
+        cached = self._cache.get('syllables')
+        if cached is None or cached[0] is not syllable_dict:
+            cached = (syllable_dict, SyllableIndex(syllable_dict, self.D))
+            self._cache['syllables'] = cached
+
+        return cached[1]
+
+
+    def _reversed_transitions(self):
+        '''
+        Returns the transition matrix for generating backwards, i.e. A
+        transposed with each row renormalized, along with the cumulative
+        sums of its rows as lists. Both are cached until the parameters
+        change.
+        '''
+
+        if 'reversed' not in self._cache:
+            A, _, _ = self._arrays()
+            reversed_A = A.T / A.T.sum(axis=1, keepdims=True)
+
+            self._cache['reversed'] = (
+                reversed_A,
+                np.cumsum(reversed_A, axis=1, dtype=np.float64).tolist())
+
+        return self._cache['reversed']
+
+
+    def _word_states(self):
+        '''
+        Returns the D x L table whose (w, i)^th element is the probability
+        that state i generated word w, i.e. the columns of O normalized,
+        along with the cumulative sums of its rows as lists. Both are cached
+        until the parameters change.
+        '''
+
+        if 'word_states' not in self._cache:
+            _, O, _ = self._arrays()
+            word_states = (O / O.sum(axis=0)).T
+
+            self._cache['word_states'] = (word_states,
+                                          np.cumsum(word_states, axis=1,
+                                                    dtype=np.float64).tolist())
+
+        return self._cache['word_states']
+            
+    
+    def save(self, filename):
+        '''
+        Save the HMM to file. Filenames ending in .npz use the binary format
+        (see save_binary), and anything else uses the text format.
+        '''
+
+        if filename.endswith('.npz'):
+            self.save_binary(filename)
+            return
+        
+        file = open(filename, 'w')
+        
+        # Save the parameters
+        file.write(str(self.L) + "\t" + str(self.D) + "\n")
+        
+        # Save the transition matrix
+        for i in range(len(self.A)):
+            file.write("\t".join(str(x) for x in self.A[i]) + "\n")
+        
+        # Save the observation matrix
+        for i in range(len(self.O)):
+            file.write("\t".join(str(x) for x in self.O[i]) + "\n")
+            
+        file.close()
+
+
+    def save_binary(self, filename):
+        '''
+        Save the HMM to an uncompressed .npz file holding a header with L
+        and D, the matrices A and O in the HMM's dtype, and the vocabulary
+        if there is one. The matrices round-trip exactly, and since the
+        archive is not compressed, load can memory-map O straight out of it.
+        '''
+
+        A, O, _ = self._arrays()
+        arrays = {'header': np.array([self.L, self.D]), 'A': A, 'O': O}
+
+        if self.vocabulary is not None:
+            arrays['vocabulary'] = np.array(self.vocabulary, dtype=str)
+
+        with open(filename, 'wb') as file:
+            np.savez(file, **arrays)
+        
+
+def load(filename, mmap=False, dtype=None):
+    '''
+    Load an HMM from file, in either the text or the binary format.
+
+    Arguments:
+        filename:   The file to load.
+
+        mmap:       For the binary format, whether to memory-map O read-only
+                    instead of reading it into memory, so that processes
+                    loading the same file share one physical copy of it.
+
+        dtype:      Floating point type of the loaded HMM. By default the
+                    binary format keeps the dtype it was saved with, and the
+                    text format loads as np.float64. Converting a binary
+                    file to another dtype reads O into memory even if mmap
+                    is set.
+    '''
+
+    if zipfile.is_zipfile(filename):
+        return _load_binary(filename, mmap, dtype)
+    
+    A = []
+    O = []
+    
+    file = open(filename, 'r')
+    
+    # Read the parameters
+    L, D = [int(x) for x in file.readline().strip().split('\t')]
+
+    # Read the transition matrix
+    for i in range(L):
+        A.append([float(x) for x in file.readline().strip().split('\t')])
+
+    # Read the observation matrix
+    for i in range(L):
+        O.append([float(x) for x in file.readline().strip().split('\t')])
+        
+    file.close()
+    
+    return HiddenMarkovModel(A, O, dtype or np.float64)
+            
+
+def save_checkpoint(filename, hmm, iteration, log_probs):
+    '''
+    Atomically saves the state of a Baum-Welch run, so that an interrupted
+    save never leaves a truncated checkpoint behind.
+
+    Arguments:
+        filename:   The checkpoint file.
+
+        hmm:        The HMM being trained.
+
+        iteration:  The number of completed iterations.
+
+        log_probs:  The log-likelihood history so far.
+    '''
+
+    A, O, _ = hmm._arrays()
+    state = {'A': A, 'O': O, 'iteration': iteration,
+             'log_probs': list(log_probs),
+             'random_state': random.getstate(),
+             'numpy_state': np.random.get_state()}
+
+    # Write a temporary file next to the checkpoint, then rename it over.
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temporary, filename)
+
+
+def load_checkpoint(filename):
+    ''' Loads the dictionary of training state saved by save_checkpoint. '''
+
+    with open(filename, 'rb') as file:
+        return pickle.load(file)
+
+
+def _load_binary(filename, mmap, dtype=None):
+    ''' Load an HMM saved by HiddenMarkovModel.save_binary. '''
+
+    with np.load(filename) as arrays:
+        L, D = arrays['header']
+        A = arrays['A']
+        O = _mmap_npz_member(filename, 'O.npy') if mmap else arrays['O']
+
+        vocabulary = None
+        if 'vocabulary' in arrays.files:
+            vocabulary = arrays['vocabulary'].tolist()
+
+    if A.shape != (L, L) or O.shape != (L, D):
+        raise ValueError("Matrix shapes do not match the header of "
+                         + filename)
+
+    hmm = HiddenMarkovModel(A, O, dtype or O.dtype)
+    hmm.vocabulary = vocabulary
+
+    return hmm
+
+
+def _mmap_npz_member(filename, name):
+    '''
+    Memory-maps an array stored uncompressed in an .npz file, read-only.
+    '''
+
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo(name)
+
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(name + " is compressed and cannot be memory-mapped")
+
+    with open(filename, 'rb') as file:
+        # The member's data follows its local header, whose size depends on
+        # the lengths of the name and extra fields.
+        file.seek(info.header_offset)
+        local_header = file.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        file.seek(info.header_offset + 30 + name_length + extra_length)
+
+        # Skip the .npy header to the raw array data.
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order='F' if fortran_order else 'C')
+
+
+def _sparse_sum(counts, L):
+    '''
+    Sums sparse expected observation counts keyed by symbol.
+
+    Arguments:
+        counts:     A list of (symbols, counts) pairs, where symbols is an
+                    integer array of length n that may contain repeats and
+                    counts is an array of shape (L, n).
+
+        L:          Number of states.
+
+    Returns:
+        A list holding a single (symbols, counts) pair, where symbols are
+        the distinct symbols in sorted order and each column of counts is
+        the total count of its symbol. Both are empty if counts is, e.g.
+        for a shard or batch without any non-empty sequences.
+    '''
+
+    if len(counts) == 0:
+        return [(np.zeros(0, dtype=int), np.zeros((L, 0)))]
+
+    symbols = np.concatenate([pair[0] for pair in counts])
+    values = np.concatenate([pair[1] for pair in counts], axis=1)
+
+    unique, inverse = np.unique(symbols, return_inverse=True)
+    totals = np.array([np.bincount(inverse, weights=row, minlength=len(unique))
+                       for row in values])
+
+    return [(unique, totals)]
+
+
+def _sample(cdf):
+    '''
+    Samples an index from a discrete distribution in O(log n) time.
+
+    Arguments:
+        cdf:        The cumulative sums of the (possibly unnormalized)
+                    probabilities of the distribution, as a list.
+
+    Returns:
+        The sampled index.
+    '''
+
+    # Guard against the last cumulative sum rounding below the draw.
+    index = bisect.bisect_left(cdf, random.uniform(0, cdf[-1]))
+
+    return min(index, len(cdf) - 1)
+
+
+def _sample_rows(flat_cdf, n_cols, rows, rng):
+    '''
+    Samples one index from each of several rows of a row-stochastic matrix
+    with a single binary search.
+
+    Arguments:
+        flat_cdf:   The flattened table from HiddenMarkovModel._flat_cdfs,
+                    whose row i holds i plus the normalized cumulative sums
+                    of the matrix's row i.
+
+        n_cols:     Number of columns of the matrix.
+
+        rows:       Integer array of the rows to sample from.
+
+        rng:        A numpy.random.Generator.
+
+    Returns:
+        Integer array of the sampled column of each row.
+    '''
+
+    draws = rows + rng.random(len(rows))
+
+    indices = np.searchsorted(flat_cdf, draws) - rows * n_cols
+
+    return np.clip(indices, 0, n_cols - 1)
+
+
+def _shift_bits(bits, counts):
+    '''
+    Adds each of several syllable counts to a bitset of possible syllable
+    counts, i.e. returns the union of bits shifted by each count.
+    '''
+
+    shifted = 0
+    for count in counts:
+        shifted |= bits << count
+
+    return shifted
+
+
+def _sample_categorical(weights, rng):
+    '''
+    Samples one index from each row of an array of unnormalized weights.
+
+    Arguments:
+        weights:    Array of shape (K, n).
+
+        rng:        A numpy.random.Generator.
+
+    Returns:
+        Integer array of length K of the sampled indices.
+    '''
+
+    cdf = np.cumsum(weights, axis=1, dtype=np.float64)
+    if np.any(cdf[:, -1] <= 0):
+        raise ValueError("Cannot sample from a distribution with no weight")
+
+    draws = rng.random(len(cdf)) * cdf[:, -1]
+
+    return np.minimum((cdf <= draws[:, None]).sum(axis=1), cdf.shape[1] - 1)
+
+
+def _completion_weights(H, states, remaining):
+    '''
+    Looks up the weight of finishing a line after a word of each possible
+    syllable count.
+
+    Arguments:
+        H:          The H table of a line lattice, of shape (S + 1, L).
+
+        states:     Integer array of states, of any shape.
+
+        remaining:  Integer array of the same shape holding the number of
+                    syllables left before the word.
+
+    Returns:
+        Array with an extra last axis of length S + 1, whose k^th element is
+        H[remaining - k][state] if k < remaining, and 0 otherwise.
+    '''
+
+    counts = np.arange(len(H))
+    left = remaining[..., None] - counts
+
+    weights = H[np.clip(left, 0, len(H) - 1), states[..., None]]
+
+    return np.where(left > 0, weights, 0.)
+
+
+def _lattice_step(O_rows, states, remaining, stop, cont, H, rng):
+    '''
+    Samples the next word of several lines, and how many syllables it uses,
+    from a line lattice.
+
+    Arguments:
+        O_rows:     Array of shape (K, D) of the emission probabilities of
+                    each line's current state.
+
+        states:     Integer array of length K of the current states.
+
+        remaining:  Integer array of length K of the syllables left.
+
+        stop, cont: The count tables for a word that finishes the line and
+                    for a word that does not.
+
+        H:          The H table of the lattice.
+
+        rng:        A numpy.random.Generator.
+
+    Returns:
+        words:      Integer array of length K of the sampled words.
+
+        counts:     Integer array of length K of their syllable counts. A
+                    line is finished when its count equals its remaining
+                    syllables.
+    '''
+
+    completions = _completion_weights(H, states, remaining)
+    K = len(states)
+
+    # Weigh each word by every way it can continue or finish its line.
+    weights = O_rows * (stop[remaining] + completions @ cont)
+    words = _sample_categorical(weights, rng)
+
+    options = cont[:, words].T * completions
+    options[np.arange(K), remaining] += stop[remaining, words]
+
+    return words, _sample_categorical(options, rng)
+
+
+# State of a Baum-Welch worker process, set up once by _init_worker.
+_worker = {}
+
+
+def _parameter_views(params, L, D, dtype):
+    ''' Views a flat shared buffer as the L x L matrix A and L x D matrix O. '''
+
+    params = np.frombuffer(params, dtype=dtype)
+
+    return params[:L * L].reshape(L, L), params[L * L:].reshape(L, D)
+
+
+def _init_worker(params, L, D, dtype, shards, bucket_width, low_memory,
+                 trace_memory):
+    '''
+    Initializes a Baum-Welch worker process. The worker's model reads A and
+    O straight from the shared buffer, so it sees every update the parent
+    writes there without any re-pickling.
+    '''
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    A, O = _parameter_views(params, L, D, dtype)
+
+    _worker['hmm'] = HiddenMarkovModel(A, O, dtype)
+    _worker['batched'] = bucket_width is not None
+    _worker['low_memory'] = low_memory
+
+    if bucket_width is not None:
+        shards = [_length_buckets(shard, bucket_width) for shard in shards]
+    _worker['shards'] = shards
+
+
+def _shard_counts(shard):
+    '''
+    Computes the expected counts of one shard in a worker process, followed
+    by the seconds spent in its forward and backward passes and its peak
+    traced memory (None unless trace_memory is set).
+    '''
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    timings = {'forward_backward': 0.}
+    counts = _worker['hmm']._corpus_counts(_worker['shards'][shard],
+                                           _worker['batched'],
+                                           _worker['low_memory'], timings)
+
+    peak = None
+    if tracemalloc.is_tracing():
+        peak = tracemalloc.get_traced_memory()[1]
+
+    return counts + (timings['forward_backward'], peak)
+
+
+def _init_selection_worker(tokens, offsets):
+    '''
+    Initializes a model selection worker process. The sequences of the
+    dataset are views into the shared token array.
+    '''
+
+    tokens = np.frombuffer(tokens, dtype=np.int64)
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+
+    _worker['X'] = [tokens[offsets[i]:offsets[i + 1]]
+                    for i in range(len(offsets) - 1)]
+
+
+def _train_candidate(task):
+    ''' Trains one randomly initialized HMM in a model selection worker. '''
+
+    n_states, restart, seed, D, N_iters, bucket_width, tol, dtype = task
+    X = _worker['X']
+
+    hmm = _random_HMM(n_states, D, np.random.default_rng(seed), dtype)
+    log_probs = hmm.unsupervised_learning(X, N_iters,
+                                          bucket_width=bucket_width,
+                                          tol=tol, verbose=False)
+
+    # Score the final parameters, which the last E-step has not seen.
+    log_prob = hmm.score_batch(X)[0].sum()
+
+    # The iteration that detects convergence skips its M-step.
+    iterations = len(log_probs)
+    if tol is not None and iterations > 1 and \
+            log_probs[-1] - log_probs[-2] < tol * abs(log_probs[-2]):
+        iterations -= 1
+
+    return (n_states, restart, seed, iterations, float(log_prob),
+            hmm.A, hmm.O)
+
+
+def _length_buckets(X, bucket_width):
+    '''
+    Groups the sequences of X into buckets of similar length and pads each
+    bucket into a rectangular array. Empty sequences are dropped.
+
+    Arguments:
+        X:              A dataset consisting of input sequences in the form
+                        of lists of integers. In other words, a list of lists.
+
+        bucket_width:   Sequences whose lengths differ by less than this
+                        share a bucket.
+
+    Returns:
+        buckets:        A list of (seqs, mask) pairs, where seqs is an
+                        integer array of shape (B, T) and mask is a boolean
+                        array marking its non-padded positions.
+    '''
+
+    X = sorted((x for x in X if len(x) > 0), key=len)
+    buckets = []
+
+    start = 0
+    while start < len(X):
+        # Extend the bucket while the lengths stay within the width.
+        end = start
+        while end < len(X) and len(X[end]) < len(X[start]) + bucket_width:
+            end += 1
+
+        buckets.append(_pad_sequences(X[start:end]))
+        start = end
+
+    return buckets
+
+
+def _pad_sequences(X):
+    '''
+    Pads a list of non-empty sequences into a rectangular integer array.
+
+    Returns:
+        seqs:       Integer array of shape (len(X), T), where T is the length
+                    of the longest sequence. Padded positions hold 0.
+
+        mask:       Boolean array of the same shape that is True on the
+                    non-padded positions.
+    '''
+
+    seqs = np.zeros((len(X), max(len(x) for x in X)), dtype=int)
+    mask = np.zeros(seqs.shape, dtype=bool)
+
+    for b, x in enumerate(X):
+        seqs[b, :len(x)] = x
+        mask[b, :len(x)] = True
+
+    return seqs, mask
+
+
+def _random_HMM(L, D, rng=np.random, dtype=np.float64):
+    '''
+    Creates an HMM with L states and D observations whose transition and
+    observation matrices are randomly initialized and normalized.
+
+    Arguments:
+        L:          Number of hidden states.
+
+        D:          Number of observations.
+
+        rng:        The source of random numbers, e.g. a
+                    np.random.Generator. Defaults to the global np.random.
+
+        dtype:      The floating point type of the HMM.
+    '''
+
+    # Randomly initialize and normalize matrix A.
+    A = rng.random((L, L))
+    A /= A.sum(axis=1, keepdims=True)
+
+    # Randomly initialize and normalize matrix O.
+    O = rng.random((L, D))
+    O /= O.sum(axis=1, keepdims=True)
+
+    return HiddenMarkovModel(A, O, dtype)
+
+
+def _count_observations(X):
+    ''' Returns the number of unique observations in the dataset X. '''
+
+    # Make a set of observations.
+    observations = set()
+    for x in X:
+        observations |= set(x)
+
+    return len(observations)
+
+
+def unsupervised_HMM(X, n_states, N_iters, bucket_width=None, n_jobs=1,
+                     tol=None, seed=None, dtype=np.float64):
+    '''
+    Helper function to train an unsupervised HMM. The function determines the
+    number of unique observations in the given data, initializes
+    the transition and observation matrices, creates the HMM, and then runs
+    the training function for unsupervised learing.
+
+    Arguments:
+        X:          A dataset consisting of input sequences in the form
+                    of lists of variable length, consisting of integers 
+                    ranging from 0 to D - 1. In other words, a list of lists.
+
+        n_states:   Number of hidden states to use in training.
+        
+        N_iters:    The number of iterations to train on.
+
+        bucket_width: Passed on to HiddenMarkovModel.unsupervised_learning.
+
+        n_jobs:     Passed on to HiddenMarkovModel.unsupervised_learning.
+
+        tol:        Passed on to HiddenMarkovModel.unsupervised_learning.
+
+        seed:       Seed for the random initialization. By default the
+                    global np.random state is used.
+
+        dtype:      Floating point type of the HMM, np.float64 or
+                    np.float32.
+    '''
+
+    # Compute L and D.
+    L = n_states
+    D = _count_observations(X)
+
+    rng = np.random if seed is None else np.random.default_rng(seed)
+
+    # Train an HMM with unlabeled data.
+    HMM = _random_HMM(L, D, rng, dtype)
+    HMM.unsupervised_learning(X, N_iters, bucket_width=bucket_width,
+                              n_jobs=n_jobs, tol=tol)
+
+    return HMM
+
+
+def select_HMM(X, n_states_range, n_restarts, N_iters, bucket_width=1,
+               tol=None, n_jobs=None, seed=None, dtype=np.float64):
+    '''
+    Trains several randomly initialized HMMs for each number of hidden
+    states concurrently in a process pool, and keeps the best one for each
+    number of states. X is placed in shared memory once and read by every
+    worker instead of being copied into each task.
+
+    Arguments:
+        X:          A dataset consisting of input sequences in the form
+                    of lists of variable length, consisting of integers 
+                    ranging from 0 to D - 1. In other words, a list of lists.
+
+        n_states_range: The numbers of hidden states to try.
+
+        n_restarts: Number of random initializations per number of states.
+
+        N_iters:    The maximum number of iterations to train each HMM on.
+
+        bucket_width: Passed on to HiddenMarkovModel.unsupervised_learning.
+
+        tol:        Passed on to HiddenMarkovModel.unsupervised_learning.
+
+        n_jobs:     Number of worker processes. Defaults to the number of
+                    CPUs.
+
+        seed:       Seed from which the seed of every restart is drawn.
+
+        dtype:      Floating point type of the HMMs.
+
+    Returns:
+        best:       Dictionary mapping each number of states to the trained
+                    HMM with the highest final log-likelihood.
+
+        summary:    A list with one row per trained HMM, sorted by number of
+                    states and then log-likelihood. Each row is a dictionary
+                    with the keys 'n_states', 'restart', 'seed',
+                    'iterations' (the number of M-steps applied) and
+                    'log_likelihood'.
+    '''
+
+    D = _count_observations(X)
+
+    # Flatten the dataset into shared token and offset arrays.
+    offsets = [0]
+    for x in X:
+        offsets.append(offsets[-1] + len(x))
+
+    tokens = multiprocessing.RawArray('q', offsets[-1])
+    np.frombuffer(tokens, dtype=np.int64)[:] = [obs for x in X for obs in x]
+    offsets = multiprocessing.RawArray('q', offsets)
+
+    # Draw an independent seed for every restart.
+    rng = random.Random(seed)
+    tasks = [(n_states, restart, rng.randrange(2 ** 32), D, N_iters,
+              bucket_width, tol, dtype)
+             for n_states in n_states_range for restart in range(n_restarts)]
+
+    with multiprocessing.Pool(n_jobs, initializer=_init_selection_worker,
+                              initargs=(tokens, offsets)) as pool:
+        results = pool.map(_train_candidate, tasks)
+
+    best = {}
+    summary = []
+
+    for n_states, restart, task_seed, iterations, log_prob, A, O in results:
+        summary.append({'n_states': n_states, 'restart': restart,
+                        'seed': task_seed, 'iterations': iterations,
+                        'log_likelihood': log_prob})
+
+        if n_states not in best or log_prob > best[n_states][0]:
+            best[n_states] = (log_prob, HiddenMarkovModel(A, O, dtype))
+
+    summary.sort(key=lambda row: (row['n_states'], -row['log_likelihood']))
+    best = {n_states: hmm for n_states, (_, hmm) in best.items()}
 
+    return best, summary
@@ -0,0 +1,378 @@
+"""
+Filename:     HMM_kernels.py
+Version:      1.0
+
+Description:  Sequential kernels of the HMM that do not vectorize across
+              timesteps: the scaled forward and backward recursions, for one
+              sequence and for padded batches, and Viterbi backtracking.
+              When Numba is installed, they are JIT-compiled with njit;
+              otherwise pure NumPy versions with the same results are used.
+              Setting the environment variable HMM_KERNELS=numpy forces the
+              NumPy versions.
+
+              Numba is only imported, and the backend chosen, when a kernel
+              is first called, so importing this module stays cheap. The
+              compiled kernels are cached on disk (cache=True), so only the
+              first run on a machine pays the compile time. Call warm_up()
+              to compile them ahead of time, e.g. before a server accepts
+              requests.
+
+Organization: California Institute of Technology
+"""
+
+import os
+import numpy as np
+
+
+####################
+# NUMPY KERNELS
+####################
+
+def _forward_numpy(A, emissions, A_start):
+    '''
+    Runs the scaled forward algorithm.
+
+    Arguments:
+        A:          The L x L transition matrix.
+
+        emissions:  M x L array whose (t, j)^th element is P(x^t | y^t = j).
+
+        A_start:    The starting transition probabilities.
+
+    Returns:
+        alphas:     M x L array of normalized alphas.
+
+        scales:     Array of length M of the normalization constants.
+    '''
+
+    M, L = emissions.shape
+    alphas = np.empty((M, L))
+    scales = np.empty(M)
+
+    alpha = A_start * emissions[0]
+    for t in range(M):
+        if t > 0:
+            alpha = (alphas[t - 1] @ A) * emissions[t]
+
+        scales[t] = alpha.sum()
+        alphas[t] = alpha / scales[t]
+
+    return alphas, scales
+
+
+def _backward_numpy(A, emissions, scales, last):
+    '''
+    Runs the scaled backward algorithm with the scales of _forward_numpy.
+
+    Arguments:
+        last:       The betas of the last timestep, i.e. ones for a whole
+                    sequence.
+
+    Returns:
+        betas:      M x L array of scaled betas.
+    '''
+
+    M, L = emissions.shape
+    betas = np.empty((M, L))
+    betas[-1] = last
+
+    for t in range(M - 2, -1, -1):
+        betas[t] = A @ (emissions[t + 1] * betas[t + 1]) / scales[t + 1]
+
+    return betas
+
+
+def _batch_forward_numpy(A, emissions, A_start, mask):
+    '''
+    Runs the scaled forward algorithm on a batch of padded sequences.
+    Padded positions carry the last alpha forward with a scale of one.
+
+    Arguments:
+        emissions:  B x T x L array whose (b, t, j)^th element is
+                    P(x_b^t | y^t = j).
+
+        mask:       B x T boolean array that is True on the real positions.
+
+    Returns:
+        alphas:     B x T x L array of normalized alphas.
+
+        scales:     B x T array of the normalization constants.
+    '''
+
+    B, T, L = emissions.shape
+    alphas = np.empty((B, T, L))
+    scales = np.ones((B, T))
+
+    alpha = A_start * emissions[:, 0]
+    for t in range(T):
+        if t > 0:
+            alpha = (alphas[:, t - 1] @ A) * emissions[:, t]
+            alpha = np.where(mask[:, t, None], alpha, alphas[:, t - 1])
+
+        scales[:, t] = alpha.sum(axis=1)
+        alphas[:, t] = alpha / scales[:, t, None]
+
+    return alphas, scales
+
+
+def _batch_backward_numpy(A, emissions, scales, mask):
+    '''
+    Runs the scaled backward algorithm on a batch of padded sequences with
+    the scales of _batch_forward_numpy. Betas stay at one until a
+    sequence's last real position.
+
+    Returns:
+        betas:      B x T x L array of scaled betas.
+    '''
+
+    B, T, L = emissions.shape
+    betas = np.ones((B, T, L))
+
+    for t in range(T - 2, -1, -1):
+        beta = (emissions[:, t + 1] * betas[:, t + 1]) @ A.T \
+               / scales[:, t + 1, None]
+        betas[:, t] = np.where(mask[:, t + 1, None], beta, 1.)
+
+    return betas
+
+
+def _backtrack_numpy(pointers, last_states):
+    '''
+    Follows Viterbi back-pointers.
+
+    Arguments:
+        pointers:   B x T x L integer array. The (b, t, j)^th element is the
+                    best previous state of sequence b for state j at time t.
+
+        last_states: Integer array of length B of the best final states.
+
+    Returns:
+        paths:      B x T integer array of the max probability states.
+    '''
+
+    B, T, _ = pointers.shape
+    paths = np.empty((B, T), dtype=pointers.dtype)
+    paths[:, -1] = last_states
+
+    for t in range(T - 1, 0, -1):
+        paths[:, t - 1] = pointers[np.arange(B), t, paths[:, t]]
+
+    return paths
+
+
+####################
+# NUMBA KERNELS
+####################
+
+# Loop versions of the kernels, which _backend compiles with Numba. They are
+# plain functions until then, so that importing this module does not import
+# Numba.
+
+def _forward_loops(A, emissions, A_start):
+    M, L = emissions.shape
+    alphas = np.empty((M, L))
+    scales = np.empty(M)
+
+    for t in range(M):
+        if t == 0:
+            for curr in range(L):
+                alphas[t, curr] = A_start[curr]
+        else:
+            # Sum over the previous states row by row of A, so that the
+            # inner loop runs over contiguous memory.
+            alphas[t] = 0.
+            for prev in range(L):
+                alpha = alphas[t - 1, prev]
+                for curr in range(L):
+                    alphas[t, curr] += alpha * A[prev, curr]
+
+        for curr in range(L):
+            alphas[t, curr] *= emissions[t, curr]
+
+        scales[t] = alphas[t].sum()
+        alphas[t] /= scales[t]
+
+    return alphas, scales
+
+
+def _backward_loops(A, emissions, scales, last):
+    M, L = emissions.shape
+    betas = np.empty((M, L))
+    betas[M - 1] = last
+
+    # As in the forward kernel, the inner loop runs over contiguous rows,
+    # here of the transpose of A.
+    A_T = np.ascontiguousarray(A.T)
+
+    for t in range(M - 2, -1, -1):
+        betas[t] = 0.
+        for nxt in range(L):
+            weight = emissions[t + 1, nxt] * betas[t + 1, nxt]
+            for curr in range(L):
+                betas[t, curr] += A_T[nxt, curr] * weight
+
+        betas[t] /= scales[t + 1]
+
+    return betas
+
+
+def _batch_forward_loops(A, emissions, A_start, mask):
+    B, T, L = emissions.shape
+    alphas = np.empty((B, T, L))
+    scales = np.ones((B, T))
+
+    for b in range(B):
+        for t in range(T):
+            if t == 0:
+                for curr in range(L):
+                    alphas[b, t, curr] = A_start[curr]
+            elif not mask[b, t]:
+                alphas[b, t] = alphas[b, t - 1]
+                continue
+            else:
+                alphas[b, t] = 0.
+                for prev in range(L):
+                    alpha = alphas[b, t - 1, prev]
+                    for curr in range(L):
+                        alphas[b, t, curr] += alpha * A[prev, curr]
+
+            for curr in range(L):
+                alphas[b, t, curr] *= emissions[b, t, curr]
+
+            scales[b, t] = alphas[b, t].sum()
+            alphas[b, t] /= scales[b, t]
+
+    return alphas, scales
+
+
+def _batch_backward_loops(A, emissions, scales, mask):
+    B, T, L = emissions.shape
+    betas = np.ones((B, T, L))
+    A_T = np.ascontiguousarray(A.T)
+
+    for b in range(B):
+        for t in range(T - 2, -1, -1):
+            if not mask[b, t + 1]:
+                continue
+
+            betas[b, t] = 0.
+            for nxt in range(L):
+                weight = emissions[b, t + 1, nxt] * betas[b, t + 1, nxt]
+                for curr in range(L):
+                    betas[b, t, curr] += A_T[nxt, curr] * weight
+
+            betas[b, t] /= scales[b, t + 1]
+
+    return betas
+
+
+def _backtrack_loops(pointers, last_states):
+    B, T, _ = pointers.shape
+    paths = np.empty((B, T), dtype=pointers.dtype)
+
+    for b in range(B):
+        state = last_states[b]
+        paths[b, T - 1] = state
+        for t in range(T - 1, 0, -1):
+            state = pointers[b, t, state]
+            paths[b, t - 1] = state
+
+    return paths
+
+
+####################
+# BACKEND SELECTION
+####################
+
+# The kernels of the chosen backend and its name, filled in on first use.
+_kernels = {}
+
+
+def _backend():
+    '''
+    Returns the kernels of the backend, choosing it on the first call: the
+    loop kernels compiled with Numba if it can be imported and HMM_KERNELS
+    is not 'numpy', and the NumPy kernels otherwise.
+    '''
+
+    if not _kernels:
+        numba = None
+        if os.environ.get('HMM_KERNELS', 'auto') != 'numpy':
+            try:
+                import numba
+            except ImportError:
+                pass
+
+        if numba is not None:
+            jit = numba.njit(cache=True)
+            _kernels.update(BACKEND='numba',
+                            forward=jit(_forward_loops),
+                            backward=jit(_backward_loops),
+                            batch_forward=jit(_batch_forward_loops),
+                            batch_backward=jit(_batch_backward_loops),
+                            backtrack=jit(_backtrack_loops))
+        else:
+            _kernels.update(BACKEND='numpy',
+                            forward=_forward_numpy,
+                            backward=_backward_numpy,
+                            batch_forward=_batch_forward_numpy,
+                            batch_backward=_batch_backward_numpy,
+                            backtrack=_backtrack_numpy)
+
+    return _kernels
+
+
+def __getattr__(name):
+    ''' Looks up BACKEND, the name of the backend, choosing it if needed. '''
+
+    if name == 'BACKEND':
+        return _backend()['BACKEND']
+
+    raise AttributeError("module " + __name__ + " has no attribute " + name)
+
+
+def forward(A, emissions, A_start):
+    ''' Runs the scaled forward algorithm, see _forward_numpy. '''
+
+    return _backend()['forward'](A, emissions, A_start)
+
+
+def backward(A, emissions, scales, last):
+    ''' Runs the scaled backward algorithm, see _backward_numpy. '''
+
+    return _backend()['backward'](A, emissions, scales, last)
+
+
+def batch_forward(A, emissions, A_start, mask):
+    ''' Runs the batched forward algorithm, see _batch_forward_numpy. '''
+
+    return _backend()['batch_forward'](A, emissions, A_start, mask)
+
+
+def batch_backward(A, emissions, scales, mask):
+    ''' Runs the batched backward algorithm, see _batch_backward_numpy. '''
+
+    return _backend()['batch_backward'](A, emissions, scales, mask)
+
+
+def backtrack(pointers, last_states):
+    ''' Follows Viterbi back-pointers, see _backtrack_numpy. '''
+
+    return _backend()['backtrack'](pointers, last_states)
+
+
+def warm_up():
+    ''' Chooses the backend and compiles the kernels ahead of their use. '''
+
+    # The HMM's matrices are read-only, which Numba compiles separately.
+    A = np.full((2, 2), .5)
+    A.flags.writeable = False
+    A_start = np.full(2, .5)
+    emissions = np.full((3, 2), .5)
+    mask = np.ones((1, 3), dtype=bool)
+
+    alphas, scales = forward(A, emissions, A_start)
+    backward(A, emissions, scales, np.ones(2))
+    alphas, scales = batch_forward(A, emissions[None], A_start, mask)
+    batch_backward(A, emissions[None], scales, mask)
+    backtrack(np.zeros((1, 3, 2), dtype=np.int64), np.zeros(1, dtype=np.int64))
@@ -0,0 +1,153 @@
+"""
+Filename:     HMM_report.py
+Version:      1.0
+
+Description:  Training reports for HiddenMarkovModel.unsupervised_learning.
+              JSONLinesReporter is a training callback that writes the
+              statistics of every iteration as one JSON object per line,
+              and summarize turns such a file into a per-phase profile.
+
+              Usage:
+                  with HMM_report.JSONLinesReporter("train.jsonl") as report:
+                      hmm.unsupervised_learning(X, 100, callbacks=[report],
+                                                trace_memory=True)
+
+                  python HMM_report.py train.jsonl
+
+Organization: California Institute of Technology
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+# The timed phases of an iteration, in the order they are reported.
+PHASES = ['forward_backward', 'e_step', 'm_step', 'iteration']
+
+
+class JSONLinesReporter:
+    '''
+    Class implementation of a training callback that appends the statistics
+    of each iteration to a JSON lines file.
+    '''
+
+    def __init__(self, filename, append=False, **fields):
+        '''
+        Opens the report file.
+
+        Arguments:
+            filename:   The file to write to.
+
+            append:     Whether to append to an existing file instead of
+                        overwriting it, e.g. when resuming from a
+                        checkpoint.
+
+            fields:     Extra fields written into every line, such as the
+                        run's number of states or the machine it ran on.
+        '''
+
+        self.file = open(filename, 'a' if append else 'w')
+        self.fields = fields
+
+
+    def __call__(self, stats):
+        ''' Writes the statistics of one iteration, stamped with the time. '''
+
+        record = dict(self.fields, time=time.time(), **stats)
+        self.file.write(json.dumps(record) + "\n")
+
+        # Flush every line so the report can be followed while training.
+        self.file.flush()
+
+
+    def close(self):
+        ''' Closes the report file. '''
+
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_report(filename):
+    ''' Reads the list of records written by a JSONLinesReporter. '''
+
+    with open(filename) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def summarize(records):
+    '''
+    Summarizes training records into a per-phase profile.
+
+    Arguments:
+        records:    A list of iteration statistics, as passed to training
+                    callbacks or read by read_report.
+
+    Returns:
+        summary:    A dictionary with the number of iterations, the final
+                    log-likelihood, the mean sequences per second, the
+                    largest peak memory (None if it was not traced), and
+                    for each phase its total and mean seconds and its share
+                    of the total iteration time.
+    '''
+
+    total = sum(record['iteration_seconds'] for record in records)
+    peaks = [record['peak_memory_bytes'] for record in records
+             if record.get('peak_memory_bytes') is not None]
+
+    phases = {}
+    for phase in PHASES:
+        seconds = np.array([record[phase + '_seconds'] for record in records])
+        phases[phase] = {'total_seconds': float(seconds.sum()),
+                         'mean_seconds': float(seconds.mean()),
+                         'share': float(seconds.sum() / total)}
+
+    return {'iterations': len(records),
+            'log_likelihood': records[-1]['log_likelihood'],
+            'sequences_per_second': float(np.mean(
+                [record['sequences_per_second'] for record in records])),
+            'peak_memory_bytes': max(peaks) if peaks else None,
+            'phases': phases}
+
+
+def format_summary(summary):
+    ''' Formats a summary from summarize as a table. '''
+
+    lines = ["Iterations: %d\tLog-likelihood: %.2f\tSequences/second: %.0f"
+             % (summary['iterations'], summary['log_likelihood'],
+                summary['sequences_per_second'])]
+
+    if summary['peak_memory_bytes'] is not None:
+        lines.append("Peak memory: %.1f MB"
+                     % (summary['peak_memory_bytes'] / 2 ** 20))
+
+    lines.append("%-18s %12s %12s %8s" % ("Phase", "Total (s)", "Mean (ms)",
+                                          "Share"))
+    for phase in PHASES:
+        stats = summary['phases'][phase]
+        lines.append("%-18s %12.3f %12.3f %7.1f%%"
+                     % (phase, stats['total_seconds'],
+                        1000 * stats['mean_seconds'], 100 * stats['share']))
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a JSON lines "
+                                                 "training report.")
+    parser.add_argument("report")
+    args = parser.parse_args()
+
+    print(format_summary(summarize(read_report(args.report))))
+
+
+if __name__ == "__main__":
+    main()
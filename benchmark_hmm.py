@@ -0,0 +1,513 @@
+"""
+Filename:     benchmark_hmm.py
+Version:      1.0
+
+Description:  Benchmark suite for the HMM and the sonnet pipeline. Times
+              forward and backward, one Baum-Welch iteration,
+              generate_emission(100000), generate_line, a full 14-line
+              sonnet from 14 generate_line calls, and saving and loading.
+              Runs on synthetic models swept over the number of states L
+              and the vocabulary size D, and on a model of shakespeare.txt.
+
+              The core benchmarks only use the original API of HMM.py, so
+              the suite also runs on the original tree to give the "before"
+              numbers; benchmarks of later additions, such as bucketed
+              training, the exact line sampler and the binary format, are
+              only listed when the HMM has them. The original code is pure
+              Python, so use --quick or small --sizes with it.
+
+              Every benchmark is called once untimed, so caches and compiled
+              kernels are in place, then timed up to --repeat times within
+              --max-seconds. The fastest run is the reported time.
+
+              Usage:
+                  python benchmark_hmm.py --save baseline.json
+                  (make a change)
+                  python benchmark_hmm.py --compare baseline.json
+
+              The comparison flags every benchmark that got slower than
+              --threshold (10% by default) and exits with status 1 if any
+              did.
+
+Organization: California Institute of Technology
+"""
+
+import argparse
+import contextlib
+import fnmatch
+import inspect
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import HMM
+
+# Modules added along with the optimized HMM, missing from the original tree.
+try:
+    import HMM_kernels
+    import generate_hmm
+    from syllables import SyllableIndex
+except ImportError:
+    HMM_kernels = generate_hmm = SyllableIndex = None
+
+# The synthetic (L, D) sizes benchmarked by default and with --quick.
+SIZES = [(L, D) for L in (10, 50, 200) for D in (1000, 10000, 50000)]
+QUICK_SIZES = [(10, 1000), (50, 10000)]
+
+# Length of the sequence given to forward and backward.
+SEQUENCE_LENGTH = 100
+
+# Shape of the synthetic training set: sequences of about a line's length.
+N_SEQUENCES = 1000
+LINE_LENGTH = 8
+
+
+def time_call(function, setup=None, repeat=5, max_seconds=2.):
+    '''
+    Times a function, timeit style.
+
+    Arguments:
+        function:   The function to time. It is called with the values
+                    returned by setup.
+
+        setup:      Optional function run untimed before every call, which
+                    returns a tuple of arguments for function.
+
+        repeat:     The most timed calls to make.
+
+        max_seconds: No new timed call starts after this many seconds, but
+                    there is always at least one.
+
+    Returns:
+        times:      The seconds taken by each timed call.
+    '''
+
+    # Untimed warm-up call.
+    function(*(setup() if setup else ()))
+
+    times = []
+    start = time.perf_counter()
+
+    while len(times) < repeat and (
+            not times or time.perf_counter() - start < max_seconds):
+        args = setup() if setup else ()
+
+        call_start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - call_start)
+
+    return times
+
+
+def accepts(function, argument):
+    ''' Returns whether a function takes an argument of the given name. '''
+
+    return argument in inspect.signature(function).parameters
+
+
+def sample_sequences(A, O, K, M, rng):
+    '''
+    Samples K sequences of length M from the HMM with matrices A and O,
+    starting from uniformly chosen states. This does not use the HMM's own
+    samplers, so the workloads are the same for every version of HMM.py.
+
+    Returns:
+        X:          Integer array of shape (K, M).
+    '''
+
+    L, D = O.shape
+    A_cdf = np.cumsum(A, axis=1)
+    O_cdf = np.cumsum(O, axis=1)
+    X = np.empty((K, M), dtype=int)
+
+    for k in range(K):
+        state = rng.integers(L)
+        for t in range(M):
+            X[k, t] = min(np.searchsorted(O_cdf[state], rng.random()
+                                          * O_cdf[state, -1]), D - 1)
+            state = min(np.searchsorted(A_cdf[state], rng.random()
+                                        * A_cdf[state, -1]), L - 1)
+
+    return X
+
+
+def usable_rhymes(rhymes, syllable_dict):
+    ''' Keeps the rhyme sets with two or more words with syllable data. '''
+
+    rhymes = [sorted(word for word in rhyme if word in syllable_dict)
+              for rhyme in rhymes]
+
+    return [rhyme for rhyme in rhymes if len(rhyme) >= 2]
+
+
+def synthetic_workload(L, D, seed=0):
+    '''
+    Builds a random model with L states and D words, with a matching random
+    syllable dictionary, rhymes and training set.
+
+    Returns:
+        workload:   A dictionary with the 'hmm', a training set 'X', a
+                    sequence 'x' of length SEQUENCE_LENGTH, the
+                    'syllable_dict' and the 'rhymes'.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    A = rng.random((L, L))
+    A /= A.sum(axis=1, keepdims=True)
+    O = rng.random((L, D))
+    O /= O.sum(axis=1, keepdims=True)
+    hmm = HMM.HiddenMarkovModel(A, O)
+
+    # Every word takes one to three syllables, and a few words can take one
+    # more at the end of a line.
+    normal = rng.integers(1, 4, size=D)
+    end = rng.random(D) < 0.1
+    syllable_dict = {word: {'normal': [int(normal[word])],
+                            'end': [int(normal[word]) + 1] if end[word] else []}
+                     for word in range(D)}
+
+    # Rhyme sets of four words.
+    words = rng.permutation(D)[:D - D % 4]
+    rhymes = [list(rhyme) for rhyme in words.reshape(-1, 4).tolist()]
+
+    X = sample_sequences(A, O, N_SEQUENCES, LINE_LENGTH, rng).tolist()
+    x = sample_sequences(A, O, 1, SEQUENCE_LENGTH, rng)[0].tolist()
+
+    return {'hmm': hmm, 'X': X, 'x': x, 'syllable_dict': syllable_dict,
+            'rhymes': rhymes}
+
+
+def corpus_workload(data_dir, model=None, seed=0):
+    '''
+    Builds the same workload as synthetic_workload from shakespeare.txt,
+    either with a saved model or with a 10-state model trained for 10
+    iterations.
+    '''
+
+    # The original preprocess_hmm imports the plotting libraries, so it is
+    # only imported when the corpus is benchmarked.
+    import preprocess_hmm
+
+    quatrains, voltas, couplets, word_to_int_map, _, rhymes = \
+        preprocess_hmm.parse_file(os.path.join(data_dir, "shakespeare.txt"))
+    syllable_dict = preprocess_hmm.parse_syllables(
+        os.path.join(data_dir, "Syllable_dictionary.txt"), word_to_int_map)
+
+    X = quatrains + voltas + couplets
+
+    if model is not None:
+        hmm = HMM.load(model)
+    else:
+        rng = np.random.default_rng(seed)
+        A = rng.random((10, 10))
+        A /= A.sum(axis=1, keepdims=True)
+        O = rng.random((10, len(word_to_int_map)))
+        O /= O.sum(axis=1, keepdims=True)
+
+        hmm = HMM.HiddenMarkovModel(A, O)
+        with contextlib.redirect_stdout(io.StringIO()):
+            hmm.unsupervised_learning(X, 10)
+
+    x = [word for line in X for word in line][:SEQUENCE_LENGTH]
+
+    return {'hmm': hmm, 'X': X, 'x': x, 'syllable_dict': syllable_dict,
+            'rhymes': rhymes}
+
+
+def generate_sonnet(hmm, rhymes, syllable_dict):
+    '''
+    Generates a sonnet with 14 calls to generate_line, as preprocess_hmm
+    first did: three quatrains and a couplet, each line generated backwards
+    from its rhyming word. rhymes must come from usable_rhymes.
+    '''
+
+    initials = []
+    for i in range(3):
+        rhyme_a, rhyme_b = [random.sample(rhyme, 2)
+                            for rhyme in random.sample(rhymes, 2)]
+        initials += [rhyme_a[0], rhyme_b[0], rhyme_a[1], rhyme_b[1]]
+    initials += random.sample(random.choice(rhymes), 2)
+
+    return [hmm.generate_line(10, syllable_dict, reverse=True,
+                              initial=initial)[0] for initial in initials]
+
+
+def benchmark_cases(workload, directory):
+    '''
+    Lists the benchmarks of a workload.
+
+    Arguments:
+        workload:   A workload from synthetic_workload or corpus_workload.
+
+        directory:  A scratch directory for the saved models.
+
+    Returns:
+        cases:      A list of (name, function, setup) triples for time_call.
+    '''
+
+    hmm, X, x = workload['hmm'], workload['X'], workload['x']
+    syllable_dict = workload['syllable_dict']
+    rhymes = usable_rhymes(workload['rhymes'], syllable_dict)
+
+    text = os.path.join(directory, "hmm.txt")
+    hmm.save(text)
+
+    def fresh_model():
+        # The original training writes into A and O, so it gets copies.
+        return (HMM.HiddenMarkovModel(np.array(hmm.A), np.array(hmm.O)),)
+
+    cases = [
+        ('forward', lambda: hmm.forward(x), None),
+        ('backward', lambda: hmm.backward(x), None),
+        ('baum_welch', lambda model: model.unsupervised_learning(X, 1),
+         fresh_model),
+        ('generate_emission', lambda: hmm.generate_emission(100000), None),
+        ('generate_line', lambda: hmm.generate_line(10, syllable_dict),
+         None),
+        ('sonnet', lambda: generate_sonnet(hmm, rhymes, syllable_dict),
+         None),
+        ('save_text', lambda: hmm.save(text), None),
+        ('load_text', lambda: HMM.load(text), None),
+    ]
+
+    # Benchmarks of the additions to the original API.
+    if accepts(hmm.unsupervised_learning, 'bucket_width'):
+        cases.append(('baum_welch_bucketed',
+                      lambda model: model.unsupervised_learning(
+                          X, 1, bucket_width=1), fresh_model))
+
+    if hasattr(hmm, 'generate_line_exact') and generate_hmm is not None:
+        index = SyllableIndex(syllable_dict, hmm.D)
+        cases += [
+            ('generate_line_exact',
+             lambda: hmm.generate_line_exact(10, index), None),
+            ('sonnet_exact',
+             lambda: generate_hmm.generate_sonnets(hmm, workload['rhymes'],
+                                                   index, 1), None),
+        ]
+
+    if hasattr(hmm, 'save_binary'):
+        binary = os.path.join(directory, "hmm.npz")
+        hmm.save_binary(binary)
+        cases += [
+            ('save_binary', lambda: hmm.save_binary(binary), None),
+            ('load_binary', lambda: HMM.load(binary), None),
+            ('load_binary_mmap', lambda: HMM.load(binary, mmap=True), None),
+        ]
+
+    return cases
+
+
+def run(workloads, patterns=None, repeat=5, max_seconds=2., verbose=True):
+    '''
+    Runs the benchmarks of several workloads.
+
+    Arguments:
+        workloads:  A list of (prefix, build) pairs, where build returns a
+                    workload. Each workload is built, benchmarked and
+                    dropped in turn, so only one is in memory at a time.
+                    A workload that fails to import what it needs is
+                    skipped with a message.
+
+        patterns:   If given, only benchmarks whose full name matches one of
+                    these shell-style patterns are run.
+
+        repeat, max_seconds: Passed on to time_call.
+
+        verbose:    Whether to print each result as it finishes.
+
+    Returns:
+        results:    Dictionary mapping each benchmark's full name, e.g.
+                    'synthetic L=10 D=1000/forward', to a dictionary of its
+                    'min' and 'median' seconds and number of 'runs'.
+    '''
+
+    results = {}
+    directory = tempfile.mkdtemp()
+
+    try:
+        for prefix, build in workloads:
+            # Skip building workloads that no pattern can select.
+            if patterns and not any('/' not in pattern or fnmatch.fnmatch(
+                    prefix, pattern.split('/')[0]) for pattern in patterns):
+                continue
+
+            try:
+                workload = build()
+            except ImportError as error:
+                print("Skipping " + prefix + ": " + str(error),
+                      file=sys.stderr)
+                continue
+
+            for name, function, setup in benchmark_cases(workload,
+                                                         directory):
+                name = prefix + '/' + name
+                if patterns and not any(fnmatch.fnmatch(name, pattern)
+                                        for pattern in patterns):
+                    continue
+
+                # Seed the global generators used by the samplers.
+                random.seed(0)
+                np.random.seed(0)
+
+                times = time_call(function, setup, repeat, max_seconds)
+                results[name] = {'min': min(times),
+                                 'median': float(np.median(times)),
+                                 'runs': len(times)}
+
+                if verbose:
+                    print("%-50s %12.3f ms %12.3f ms %4d"
+                          % (name, 1000 * results[name]['min'],
+                             1000 * results[name]['median'], len(times)))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+
+def environment():
+    ''' Describes the machine and libraries the benchmarks ran with. '''
+
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'kernels': HMM_kernels.BACKEND if HMM_kernels else None,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def compare(results, baseline, threshold=0.1):
+    '''
+    Compares results against a baseline by their fastest runs.
+
+    Arguments:
+        results:    Results from run.
+
+        baseline:   Results from run, e.g. loaded from a saved baseline.
+
+        threshold:  Relative slowdown past which a benchmark is flagged.
+
+    Returns:
+        rows:       A list of (name, baseline seconds, seconds, ratio,
+                    status) tuples, where status is 'slower', 'faster',
+                    'same' or 'new'. Baseline seconds and ratio are None for
+                    new benchmarks.
+
+        slower:     The names of the flagged benchmarks.
+    '''
+
+    rows = []
+    slower = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            rows.append((name, None, result['min'], None, 'new'))
+            continue
+
+        ratio = result['min'] / baseline[name]['min']
+        if ratio > 1 + threshold:
+            status = 'slower'
+            slower.append(name)
+        elif ratio < 1 / (1 + threshold):
+            status = 'faster'
+        else:
+            status = 'same'
+
+        rows.append((name, baseline[name]['min'], result['min'], ratio,
+                     status))
+
+    return rows, slower
+
+
+def format_comparison(rows):
+    ''' Formats the rows from compare as a table. '''
+
+    lines = ["%-50s %13s %13s %8s  %s" % ("Benchmark", "Baseline (ms)",
+                                          "Now (ms)", "Ratio", "Status")]
+
+    for name, before, after, ratio, status in rows:
+        if before is None:
+            lines.append("%-50s %13s %13.3f %8s  %s"
+                         % (name, '-', 1000 * after, '-', status))
+        else:
+            lines.append("%-50s %13.3f %13.3f %8.2f  %s"
+                         % (name, 1000 * before, 1000 * after, ratio,
+                            status.upper() if status == 'slower'
+                            else status))
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the HMM and the "
+                                                 "sonnet pipeline.")
+    parser.add_argument("--sizes", nargs='+', default=None, metavar="LxD",
+                        help="synthetic sizes, e.g. 10x1000 200x50000")
+    parser.add_argument("--quick", action="store_true",
+                        help="only benchmark the small synthetic sizes")
+    parser.add_argument("--no-corpus", action="store_true",
+                        help="skip the shakespeare.txt benchmarks")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--model", default=None,
+                        help="saved model of the corpus to benchmark instead "
+                             "of training one")
+    parser.add_argument("--only", nargs='+', default=None, metavar="PATTERN",
+                        help="only run benchmarks matching these patterns, "
+                             "e.g. '*/forward' 'shakespeare/*'")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=2.)
+    parser.add_argument("--save", default=None,
+                        help="save the results as a baseline file")
+    parser.add_argument("--compare", default=None,
+                        help="compare the results against a baseline file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown flagged by --compare")
+    args = parser.parse_args()
+
+    if args.sizes is not None:
+        sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes]
+    else:
+        sizes = QUICK_SIZES if args.quick else SIZES
+
+    workloads = [('synthetic L=%d D=%d' % (L, D),
+                  lambda L=L, D=D: synthetic_workload(L, D))
+                 for L, D in sizes]
+    if not args.no_corpus:
+        workloads.append(('shakespeare',
+                          lambda: corpus_workload(args.data, args.model)))
+
+    print("%-50s %15s %15s %4s" % ("Benchmark", "Min", "Median", "Runs"))
+    results = run(workloads, args.only, args.repeat, args.max_seconds)
+
+    if args.save is not None:
+        with open(args.save, 'w') as file:
+            json.dump({'environment': environment(), 'results': results},
+                      file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+        rows, slower = compare(results, baseline['results'], args.threshold)
+
+        print()
+        print(format_comparison(rows))
+
+        if slower:
+            print("\n%d benchmark(s) slower than the baseline by more than "
+                  "%d%%" % (len(slower), round(100 * args.threshold)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Filename:     generate_hmm.py
+Version:      1.0
+
+Description:  Generates batches of rhyming sonnets from a trained HMM, and
+              benchmarks the generation throughput.
+
+Organization: California Institute of Technology
+"""
+
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import time
+
+import HMM
+from syllables import SyllableIndex
+
+# Sonnets are generated in blocks of this many, each block with its own
+# random stream, so the output does not depend on the number of workers.
+SONNETS_PER_BLOCK = 64
+
+# State of a generation worker process, set up once by _init_worker.
+_worker = {}
+
+
+def sample_initials(rhymes, rng):
+    """
+    Samples the rhyming last word of each of the 14 lines of a sonnet, in
+    the pattern abab cdcd efef gg.
+    """
+
+    initials = []
+
+    # Three quatrains with two rhymes each
+    for i in range(3):
+        a, b = rng.choice(len(rhymes), 2, replace=False)
+        rhyme_a = rng.choice(rhymes[a], 2, replace=False)
+        rhyme_b = rng.choice(rhymes[b], 2, replace=False)
+        initials += [rhyme_a[0], rhyme_b[0], rhyme_a[1], rhyme_b[1]]
+
+    # One couplet
+    initials += list(rng.choice(rhymes[rng.integers(len(rhymes))], 2,
+                                replace=False))
+
+    return initials
+
+
+def generate_block(hmm, rhymes, syllable_index, n, rng, syllables=10):
+    """
+    Generates n sonnets at once by sampling all of their lines together
+    with the HMM's exact line sampler. Each line is generated backwards
+    from its rhyming word.
+    """
+
+    initials = []
+    for i in range(n):
+        initials += sample_initials(rhymes, rng)
+
+    lines = hmm.generate_lines_exact(syllables, syllable_index, reverse=True,
+                                     initials=initials, seed=rng)
+    emissions = [emission for emission, states in lines]
+
+    return [emissions[i:i + 14] for i in range(0, len(emissions), 14)]
+
+
+def generate_sonnets(hmm, rhymes, syllable_index, n, seed=None, n_jobs=1,
+                     syllables=10):
+    """
+    Generates n sonnets, each as a list of 14 lines of word ids.
+
+    The sonnets are split into blocks of SONNETS_PER_BLOCK, and every block
+    draws from its own random stream spawned from seed. The blocks can be
+    spread over n_jobs worker processes, and the output for a given seed is
+    the same for any number of workers.
+    """
+
+    if not isinstance(syllable_index, SyllableIndex):
+        syllable_index = SyllableIndex(syllable_index, hmm.D)
+
+    # Only rhyme sets with at least two words that have syllable data are
+    # usable
+    rhymes = [sorted(word for word in rhyme if syllable_index.known[word])
+              for rhyme in rhymes]
+    rhymes = [rhyme for rhyme in rhymes if len(rhyme) >= 2]
+
+    blocks = [min(SONNETS_PER_BLOCK, n - start)
+              for start in range(0, n, SONNETS_PER_BLOCK)]
+    streams = np.random.SeedSequence(seed).spawn(len(blocks))
+    tasks = list(zip(blocks, streams))
+
+    if n_jobs > 1:
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                  initargs=(hmm, rhymes, syllable_index,
+                                            syllables)) as pool:
+            results = pool.map(_generate_task, tasks)
+    else:
+        results = [generate_block(hmm, rhymes, syllable_index, size,
+                                  np.random.default_rng(stream), syllables)
+                   for size, stream in tasks]
+
+    return [sonnet for block in results for sonnet in block]
+
+
+def _init_worker(hmm, rhymes, syllable_index, syllables):
+    """ Initializes a generation worker process. """
+
+    _worker['args'] = (hmm, rhymes, syllable_index)
+    _worker['syllables'] = syllables
+
+
+def _generate_task(task):
+    """ Generates one block of sonnets in a worker process. """
+
+    size, stream = task
+
+    return generate_block(*_worker['args'], size,
+                          np.random.default_rng(stream),
+                          _worker['syllables'])
+
+
+def format_sonnet(sonnet, int_to_word_map):
+    """ Formats a sonnet as text, with the couplet indented. """
+
+    lines = []
+    for i, emission in enumerate(sonnet):
+        line = ' '.join(int_to_word_map[word] for word in emission)
+        lines.append(('  ' if i >= 12 else '') + line.capitalize())
+
+    return '\n'.join(lines)
+
+
+def benchmark(hmm, rhymes, syllable_index, n, n_jobs=1, seed=0):
+    """ Returns the number of sonnets generated per second. """
+
+    # Warm up the cached generation tables before timing
+    generate_sonnets(hmm, rhymes, syllable_index, 1, seed=seed)
+
+    start = time.perf_counter()
+    generate_sonnets(hmm, rhymes, syllable_index, n, seed=seed,
+                     n_jobs=n_jobs)
+
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    import preprocess_hmm
+
+    parser = argparse.ArgumentParser(description="Generate sonnets from a "
+                                                 "trained HMM.")
+    parser.add_argument("--model", default="hmm10.npz")
+    parser.add_argument("--data", default="data",
+                        help="directory holding shakespeare.txt and "
+                             "Syllable_dictionary.txt")
+    parser.add_argument("-n", type=int, default=1,
+                        help="number of sonnets to generate")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--benchmark", action="store_true",
+                        help="report sonnets/second instead of printing")
+    args = parser.parse_args()
+
+    # Parse the sonnets and the syllable data
+    _, _, _, word_to_int_map, int_to_word_map, rhymes = preprocess_hmm.parse_file(os.path.join(args.data, "shakespeare.txt"))
+    syllable_index = preprocess_hmm.parse_syllables(os.path.join(args.data, "Syllable_dictionary.txt"), word_to_int_map, as_index=True)
+
+    hmm = HMM.load(args.model, mmap=True)
+
+    if args.benchmark:
+        rate = benchmark(hmm, rhymes, syllable_index, args.n, args.jobs)
+        print("%d sonnets with %d job(s): %.1f sonnets/second"
+              % (args.n, args.jobs, rate))
+    else:
+        sonnets = generate_sonnets(hmm, rhymes, syllable_index, args.n,
+                                   seed=args.seed, n_jobs=args.jobs)
+        print('\n\n'.join(format_sonnet(sonnet, int_to_word_map)
+                          for sonnet in sonnets))
+
+
+if __name__ == "__main__":
+    main()
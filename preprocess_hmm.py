@@ -9,9 +9,9 @@ Author(s):    Dennis Lam, Garret Sullivan
 Organization: California Institute of Technology
 """
 
-import random
 import HMM
-import HMM_helper
+import generate_hmm
+from syllables import SyllableIndex
 
 def parse_line(line):
     """ Parses a line of the sonnets. """
@@ -133,8 +133,12 @@ def parse_file(filename):
     return (quatrain_lines, volta_lines, couplet_lines, obs_word_to_int, obs_int_to_word, rhymes)
 
 
-def parse_syllables(filename, word_to_int_map):
-    """ Parses the "Syllable_dictionary.txt" file containing the syllable data. """
+def parse_syllables(filename, word_to_int_map, as_index=False):
+    """
+    Parses the "Syllable_dictionary.txt" file containing the syllable data.
+    If as_index is True, the data is returned as a SyllableIndex of NumPy
+    arrays instead of a dictionary.
+    """
     
     syllable_dictionary = {}
     
@@ -168,6 +172,9 @@ def parse_syllables(filename, word_to_int_map):
     # Close the file containing the syllable data
     file_in.close()
     
+    if as_index:
+        return SyllableIndex(syllable_dictionary, len(word_to_int_map))
+
     return syllable_dictionary
 
 
@@ -177,35 +184,22 @@ def main():
     all_lines = quatrain_lines + volta_lines + couplet_lines
     
     # Parse the syllable data
-    syllable_dictionary = parse_syllables("data\\Syllable_dictionary.txt", word_to_int_map)
+    syllable_dictionary = parse_syllables("data\\Syllable_dictionary.txt", word_to_int_map, as_index=True)
     
     # Train an HMM and generate a 14-line sonnet
-    hmm10 = HMM.unsupervised_HMM(all_lines, 10, 100)
-    hmm10.save("hmm10.txt")
-    #hmm10 = HMM.load("hmm10.txt")
-    
-    # Generate three quatrains
-    for i in range(3):
-        # Select rhyming words for this quatrain
-        sample_rhymes = random.sample(rhymes, 2)
-        rhyme_a = random.sample(sample_rhymes[0], 2)
-        rhyme_b = random.sample(sample_rhymes[1], 2)
-        initials = [rhyme_a[0], rhyme_b[0], rhyme_a[1], rhyme_b[1]]
-        
-        # Generate each line backwards using the rhyming word as the initial word
-        for i in range(4):
-            emission, states = hmm10.generate_line(10, syllable_dictionary, reverse=True, initial=initials[i])
-            line = [int_to_word_map[i] for i in emission]
-            print(' '.join(line).capitalize())
-            
-    # Generate one couplet
-    rhyme_c = random.sample(random.sample(rhymes, 1)[0], 2)
-    for i in range(2):
-        emission, states = hmm10.generate_line(10, syllable_dictionary, reverse=True, initial=rhyme_c[i])
-        line = [int_to_word_map[i] for i in emission]
-        print('  ' + ' '.join(line).capitalize())
+    hmm10 = HMM.unsupervised_HMM(all_lines, 10, 100, bucket_width=1, tol=1e-4)
+    hmm10.vocabulary = [int_to_word_map[i] for i in range(len(int_to_word_map))]
+    hmm10.save("hmm10.npz")
+    #hmm10 = HMM.load("hmm10.npz")
+    
+    # Generate three quatrains and one couplet, each line generated
+    # backwards from its rhyming word
+    sonnet = generate_hmm.generate_sonnets(hmm10, rhymes, syllable_dictionary, 1)[0]
+    print(generate_hmm.format_sonnet(sonnet, int_to_word_map))
         
-    # Visualize the matrices and the states of the HMM
+    # Visualize the matrices and the states of the HMM. The plotting
+    # libraries are only imported here, so that parsing stays lightweight.
+    import HMM_helper
     HMM_helper.visualize_sparsities(hmm10, O_max_cols=100, O_vmax=1)
     HMM_helper.states_to_wordclouds(hmm10, word_to_int_map)
     
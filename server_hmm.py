@@ -0,0 +1,340 @@
+"""
+Filename:     server_hmm.py
+Version:      1.0
+
+Description:  Long-lived sonnet generation server. Loads the HMM, the
+              vocabulary, the rhymes and the syllable index once, then serves
+              line and sonnet generation requests concurrently over HTTP or
+              a Unix socket, with generation offloaded to a process pool.
+
+              Endpoints (GET, JSON responses):
+                  /line?initial=<word>&reverse=<0|1>&syllables=<n>&seed=<n>
+                  /sonnet?n=<n>&seed=<n>
+                  /metrics
+
+Organization: California Institute of Technology
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import time
+import urllib.parse
+
+import numpy as np
+
+import HMM
+import HMM_kernels
+import generate_hmm
+import preprocess_hmm
+
+# Number of recent latencies kept per endpoint for the metrics.
+LATENCY_WINDOW = 10000
+
+# Largest number of syllables per line and of sonnets per request. Larger
+# requests are rejected, since they could exhaust a worker's memory, and
+# every line length gets its own cached lattice in each worker.
+MAX_SYLLABLES = 40
+MAX_SONNETS = 100
+
+# State of a generation worker process, set up once by _init_worker.
+_worker = {}
+
+
+def load_resources(model_path, data_dir):
+    """ Loads the model, the vocabulary, the rhymes and the syllable index. """
+
+    _, _, _, word_to_int_map, int_to_word_map, rhymes = preprocess_hmm.parse_file(os.path.join(data_dir, "shakespeare.txt"))
+    syllable_index = preprocess_hmm.parse_syllables(os.path.join(data_dir, "Syllable_dictionary.txt"), word_to_int_map, as_index=True)
+
+    hmm = HMM.load(model_path, mmap=True)
+
+    return {'hmm': hmm, 'word_to_int': word_to_int_map,
+            'int_to_word': int_to_word_map, 'rhymes': rhymes,
+            'syllable_index': syllable_index}
+
+
+def _init_worker(model_path, data_dir):
+    """ Loads everything a generation worker needs, once per process. """
+
+    _worker.update(load_resources(model_path, data_dir))
+    HMM_kernels.warm_up()
+
+
+def _generate_line(initial, reverse, syllables, seed):
+    """ Generates one line in a worker process. """
+
+    hmm = _worker['hmm']
+
+    if initial is not None:
+        initial = _worker['word_to_int'][initial]
+
+    emission, states = hmm.generate_line_exact(syllables,
+                                               _worker['syllable_index'],
+                                               reverse=reverse,
+                                               initial=initial, seed=seed)
+
+    return ' '.join(_worker['int_to_word'][word] for word in emission)
+
+
+def _warm_up_worker(barrier):
+    '''
+    Generates one line in a worker process, then waits until every worker
+    has done the same, so that no worker takes two of these tasks.
+    '''
+
+    _generate_line(None, False, 10, 0)
+    barrier.wait()
+
+
+def _generate_sonnets(n, seed):
+    """ Generates n sonnets in a worker process. """
+
+    sonnets = generate_hmm.generate_sonnets(_worker['hmm'], _worker['rhymes'],
+                                            _worker['syllable_index'], n,
+                                            seed=seed)
+
+    return [generate_hmm.format_sonnet(sonnet, _worker['int_to_word'])
+            for sonnet in sonnets]
+
+
+class SonnetServer:
+    '''
+    Class implementation of the asyncio sonnet generation server.
+    '''
+
+    def __init__(self, model_path, data_dir="data", workers=None):
+        '''
+        Starts the worker pool. Every worker loads the model and the data
+        when it starts, so no request pays for it.
+
+        Arguments:
+            model_path: Path of the saved HMM.
+
+            data_dir:   Directory holding shakespeare.txt and
+                        Syllable_dictionary.txt.
+
+            workers:    Number of worker processes. Defaults to the number
+                        of CPUs.
+        '''
+
+        self.workers = workers or os.cpu_count()
+        self.resources = (model_path, data_dir)
+        self.pool = self._start_pool()
+
+        self.started = time.time()
+        self.latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        self.errors = collections.Counter()
+
+
+    def _start_pool(self):
+        ''' Starts a pool of workers that load the resources. '''
+
+        return concurrent.futures.ProcessPoolExecutor(
+            self.workers, initializer=_init_worker, initargs=self.resources)
+
+
+    def warm_up(self):
+        '''
+        Blocks until every worker has loaded the model and generated a
+        line. The workers meet at a barrier, so each of them runs one of the
+        warm-up tasks.
+        '''
+
+        with multiprocessing.Manager() as manager:
+            barrier = manager.Barrier(self.workers)
+            futures = [self.pool.submit(_warm_up_worker, barrier)
+                       for _ in range(self.workers)]
+            for future in futures:
+                future.result()
+
+
+    async def _run(self, function, *args):
+        '''
+        Runs a function in the worker pool. A pool whose worker died, e.g.
+        from running out of memory, fails every later task, so it is
+        replaced with a new one before the error is passed on.
+        '''
+
+        pool = self.pool
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, function, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # Concurrent requests on the same broken pool replace it once.
+            if self.pool is pool:
+                self.pool = self._start_pool()
+                pool.shutdown(wait=False)
+            raise
+
+
+    async def handle(self, path, query):
+        '''
+        Serves one request.
+
+        Returns:
+            status:     The HTTP status code.
+
+            body:       The response, as a JSON-serializable object.
+        '''
+
+        seed = int(query['seed']) if 'seed' in query else None
+
+        if path == '/line':
+            syllables = int(query.get('syllables', 10))
+            if not 1 <= syllables <= MAX_SYLLABLES:
+                raise ValueError("syllables must be between 1 and "
+                                 + str(MAX_SYLLABLES))
+
+            line = await self._run(_generate_line, query.get('initial'),
+                                   query.get('reverse', '0') == '1',
+                                   syllables, seed)
+            return 200, {'line': line}
+
+        if path == '/sonnet':
+            n = int(query.get('n', 1))
+            if not 1 <= n <= MAX_SONNETS:
+                raise ValueError("n must be between 1 and "
+                                 + str(MAX_SONNETS))
+
+            sonnets = await self._run(_generate_sonnets, n, seed)
+            return 200, {'sonnets': sonnets}
+
+        if path == '/metrics':
+            return 200, self.metrics()
+
+        return 404, {'error': 'unknown path ' + path}
+
+
+    def metrics(self):
+        ''' Summarizes the request latencies of each endpoint, in ms. '''
+
+        endpoints = {}
+        for path, latencies in self.latencies.items():
+            latencies = np.array(latencies) * 1000
+            endpoints[path] = {
+                'count': len(latencies),
+                'errors': self.errors[path],
+                'mean_ms': float(latencies.mean()),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p90_ms': float(np.percentile(latencies, 90)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'max_ms': float(latencies.max()),
+            }
+
+        return {'uptime_s': time.time() - self.started,
+                'endpoints': endpoints}
+
+
+    async def serve_connection(self, reader, writer):
+        ''' Serves the HTTP requests of one connection. '''
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                # Read the headers, which are only needed for keep-alive.
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip().lower()
+
+                start = time.perf_counter()
+                path = None
+                try:
+                    method, target, version = request_line.decode().split()
+                    url = urllib.parse.urlsplit(target)
+                    query = dict(urllib.parse.parse_qsl(url.query))
+                    path = url.path
+
+                    status, body = await self.handle(path, query)
+                except concurrent.futures.process.BrokenProcessPool as error:
+                    status, body = 503, {'error': repr(error)}
+                except Exception as error:
+                    status, body = 400, {'error': repr(error)}
+
+                # Only the generation endpoints are tracked by name, so that
+                # arbitrary paths cannot grow the metrics.
+                if path != '/metrics':
+                    if path not in ('/line', '/sonnet'):
+                        path = 'other'
+                    self.latencies[path].append(time.perf_counter() - start)
+                    if status != 200:
+                        self.errors[path] += 1
+
+                keep_alive = headers.get('connection') != 'close'
+                payload = json.dumps(body).encode()
+                writer.write(('HTTP/1.1 %d %s\r\n'
+                              'Content-Type: application/json\r\n'
+                              'Content-Length: %d\r\n'
+                              'Connection: %s\r\n\r\n'
+                              % (status, 'OK' if status == 200 else 'Error',
+                                 len(payload),
+                                 'keep-alive' if keep_alive else 'close')
+                              ).encode() + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def serve(self, host='127.0.0.1', port=8155, unix_path=None):
+        ''' Serves requests forever, over TCP or over a Unix socket. '''
+
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.serve_connection,
+                                                     unix_path)
+        else:
+            server = await asyncio.start_server(self.serve_connection,
+                                                host, port)
+
+        async with server:
+            await server.serve_forever()
+
+
+    def close(self):
+        ''' Shuts down the worker pool. '''
+
+        self.pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve sonnet generation "
+                                                 "from a trained HMM.")
+    parser.add_argument("--model", default="hmm10.npz")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8155)
+    parser.add_argument("--unix", default=None,
+                        help="serve on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    server = SonnetServer(args.model, args.data, args.workers)
+
+    try:
+        server.warm_up()
+        print("Serving on " + (args.unix or "%s:%d" % (args.host, args.port)))
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Filename:     syllables.py
+Version:      1.0
+
+Description:  Array-backed index of the syllable dictionary, used to mask
+              out words that do not fit in a line during generation.
+
+Organization: California Institute of Technology
+"""
+
+import numpy as np
+
+
+class SyllableIndex:
+    '''
+    Class implementation of a compact, array-backed syllable dictionary.
+    '''
+
+    def __init__(self, syllable_dict, D):
+        '''
+        Builds the index from a syllable dictionary.
+
+        Arguments:
+            syllable_dict: Dictionary mapping each word id to a dictionary
+                           with lists of its possible syllable counts under
+                           'normal' and, at the end of a line, under 'end'.
+                           This is the output of parse_syllables.
+
+            D:             Number of words in the vocabulary.
+
+        Parameters:
+            syllable_dict: The syllable dictionary.
+
+            known:         Boolean array of length D that is True for the
+                           words in the syllable dictionary.
+
+            normal_min, normal_max, end_min, end_max:
+                           Integer arrays of length D holding the smallest
+                           and largest normal and end syllable counts of each
+                           word, or -1 if it has none.
+
+            normal_bits, end_bits:
+                           Integer arrays of length D holding, for each word,
+                           a bitmask whose k^th bit is set if k is an allowed
+                           normal or end syllable count.
+
+            min_syllables: Integer array of length D holding the fewest
+                           syllables each word can take anywhere in a line.
+        '''
+
+        self.syllable_dict = syllable_dict
+        self.D = D
+
+        self.known = np.zeros(D, dtype=bool)
+        self.normal_min = np.full(D, -1)
+        self.normal_max = np.full(D, -1)
+        self.end_min = np.full(D, -1)
+        self.end_max = np.full(D, -1)
+        self.normal_bits = np.zeros(D, dtype=np.int64)
+        self.end_bits = np.zeros(D, dtype=np.int64)
+
+        for word, counts in syllable_dict.items():
+            self.known[word] = True
+
+            if len(counts['normal']) > 0:
+                self.normal_min[word] = min(counts['normal'])
+                self.normal_max[word] = max(counts['normal'])
+            if len(counts['end']) > 0:
+                self.end_min[word] = min(counts['end'])
+                self.end_max[word] = max(counts['end'])
+
+            for count in counts['normal']:
+                self.normal_bits[word] |= 1 << count
+            for count in counts['end']:
+                self.end_bits[word] |= 1 << count
+
+        # Words without any end counts fall back on their normal counts.
+        both_min = np.where(self.end_min < 0, self.normal_min,
+                            np.minimum(self.normal_min, self.end_min))
+        self.min_syllables = np.where(self.normal_min < 0, self.end_min,
+                                      both_min)
+
+        # Feasibility masks and count tables, built on demand for each
+        # line length.
+        self._masks = {}
+        self._count_tables = {}
+
+
+    def masks(self, syllables):
+        '''
+        Returns the precomputed feasibility masks for lines of a given
+        number of syllables.
+
+        Arguments:
+            syllables:  Number of syllables in the line.
+
+        Returns:
+            masks:      Float array of shape (syllables + 1, D). The (s, w)^th
+                        element is 1 if word w is in the syllable dictionary
+                        and its fewest syllables still fit in the line after
+                        s syllables have been used, and 0 otherwise.
+        '''
+
+        if syllables not in self._masks:
+            used = np.arange(syllables + 1)[:, None]
+            fits = self.known & (used + self.min_syllables <= syllables)
+
+            self._masks[syllables] = fits.astype(float)
+
+        return self._masks[syllables]
+
+
+    def count_tables(self, syllables):
+        '''
+        Returns indicator tables of the syllable counts each word can take,
+        for lines of a given number of syllables.
+
+        Arguments:
+            syllables:  Number of syllables in the line.
+
+        Returns:
+            normal:     Float array of shape (syllables + 1, D). The (k, w)^th
+                        element is 1 if word w can take k syllables in the
+                        middle of a line, and 0 otherwise.
+
+            final:      Like normal, but for the last word of a line, which
+                        can take either its normal or its end counts.
+        '''
+
+        if syllables not in self._count_tables:
+            counts = np.arange(syllables + 1)[:, None]
+            normal = (self.normal_bits >> counts) & 1
+            end = (self.end_bits >> counts) & 1
+
+            self._count_tables[syllables] = (normal.astype(float),
+                                             (normal | end).astype(float))
+
+        return self._count_tables[syllables]
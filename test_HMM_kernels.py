@@ -0,0 +1,78 @@
+"""
+Filename:     test_HMM_kernels.py
+Version:      1.0
+
+Description:  Checks that the NumPy and Numba kernel backends give the same
+              results through the HMM, including on empty sequences. Run
+              with pytest; the Numba comparison is skipped when Numba is
+              not installed.
+
+Organization: California Institute of Technology
+"""
+
+import numpy as np
+import pytest
+
+import HMM
+import HMM_kernels
+
+# A dataset with empty sequences and sequences of different lengths.
+X = [[1], [], [2, 3, 4, 0], [5] * 7, [0, 1, 2, 3, 4, 5, 0, 1, 2]]
+
+
+def run_backend(backend, monkeypatch):
+    '''
+    Runs everything that calls the kernels under one backend.
+
+    Returns:
+        results:    A list of the arrays each part produced.
+    '''
+
+    monkeypatch.setenv('HMM_KERNELS', backend)
+    monkeypatch.setattr(HMM_kernels, '_kernels', {})
+
+    hmm = HMM._random_HMM(4, 6, np.random.default_rng(0))
+    results = []
+
+    for x in X:
+        alphas, scales = hmm.scaled_forward(x)
+        results += [alphas, scales, hmm.scaled_backward(x, scales),
+                    hmm.forward(x), hmm.forward(x, normalize=True),
+                    hmm.backward(x), hmm.score(x)]
+
+    results.append(hmm.score_batch(X)[0])
+    results += [np.array(states) for states in hmm.viterbi_batch(X)]
+
+    # Train copies of the HMM with every E-step.
+    for options in [{}, {'bucket_width': 2}, {'low_memory': True}]:
+        copy = HMM.HiddenMarkovModel(hmm.A, hmm.O)
+        results.append(copy.unsupervised_learning(X, 3, verbose=False,
+                                                  **options))
+        results += [copy.A, copy.O]
+
+    assert HMM_kernels.BACKEND == backend
+
+    return results
+
+
+def test_empty_sequences(monkeypatch):
+    ''' Empty sequences have no alphas or betas and a likelihood of one. '''
+
+    results = run_backend('numpy', monkeypatch)
+    alphas, scales, betas = results[7:10]
+
+    assert alphas.shape == (0, 4) and scales.shape == (0,)
+    assert betas.shape == (0, 4)
+    assert results[13] == 0.
+
+
+def test_backends_agree(monkeypatch):
+    ''' The Numba kernels give the same results as the NumPy ones. '''
+
+    pytest.importorskip('numba')
+
+    expected = run_backend('numpy', monkeypatch)
+    results = run_backend('numba', monkeypatch)
+
+    for result, target in zip(results, expected):
+        np.testing.assert_allclose(result, target, rtol=1e-10, atol=1e-12)